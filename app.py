@@ -1,6 +1,9 @@
-from flask import Flask, render_template, request, redirect, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, session, flash, jsonify, g, has_app_context
 import sqlite3
 import hashlib
+import heapq
+import hmac
+import json
 import os
 import secrets
 from datetime import timedelta, datetime
@@ -8,16 +11,52 @@ import pytz
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_mail import Mail, Message
 import threading
+import queue
 from pin_manager import create_pin_manager
-from functools import lru_cache
-import random
-import string
+from transaction_ids import generate_transaction_ids
+from functools import wraps
+import time
+import re
 
 app = Flask(__name__)
 
+def load_or_create_secret_key(path):
+    """Lee la clave secreta guardada en disco o genera una nueva la primera vez.
+
+    La clave se escribe en un archivo temporal y se enlaza al destino con os.link, que falla
+    si otro worker ya la creó; en ese caso se usa la que quedó en disco para que todos los
+    procesos firmen las sesiones con la misma clave.
+    """
+    try:
+        with open(path, 'rb') as f:
+            key = f.read()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_bytes(32))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(tmp_path)
+
+    with open(path, 'rb') as f:
+        return f.read()
+
 # Configuración de seguridad
-# En producción, usar variables de entorno
-app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+# En producción, usar variables de entorno. Sin SECRET_KEY se persiste una clave generada
+# para que un reinicio no invalide todas las sesiones y obligue a todos a volver a iniciar sesión
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', '.secret_key')
+app.secret_key = os.environ.get('SECRET_KEY') or load_or_create_secret_key(SECRET_KEY_FILE)
 
 # Configuración de cookies seguras (solo en producción con HTTPS)
 is_production = os.environ.get('FLASK_ENV') == 'production'
@@ -28,6 +67,21 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Protección CSRF
 # Configuración de duración de sesión (30 minutos)
 app.permanent_session_lifetime = timedelta(minutes=30)
 
+# Sesiones en Redis (opcional): si REDIS_URL está definido la sesión se guarda en el servidor
+# y la cookie solo lleva el identificador, así actualizar session['saldo'] no re-firma ni
+# reenvía toda la sesión. Las claves expiran con PERMANENT_SESSION_LIFETIME.
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = None
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+    
+    redis_client = redis.Redis.from_url(REDIS_URL, socket_keepalive=True)
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis_client
+    app.config['SESSION_KEY_PREFIX'] = 'inefable:session:'
+    Session(app)
+
 # Configuración de correo electrónico (solo 2 variables necesarias)
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
@@ -66,26 +120,77 @@ if db_dir and not os.path.exists(db_dir):
         # Si no se puede crear el directorio, usar ruta por defecto
         DATABASE = 'usuarios.db'
 
+# Sentencias SQL de las rutas más usadas definidas una sola vez: el mismo texto exacto
+# permite que sqlite3 reutilice la sentencia preparada de su cache por conexión
+SQL_GET_USER_BY_EMAIL = 'SELECT id, nombre, apellido, correo, contraseña, saldo FROM usuarios WHERE correo = ?'
+SQL_DEBIT_BALANCE = 'UPDATE usuarios SET saldo = saldo - ? WHERE id = ? AND saldo >= ? RETURNING saldo'
+SQL_CREDIT_BALANCE = 'UPDATE usuarios SET saldo = saldo + ? WHERE id = ?'
+SQL_INSERT_TRANSACTION = '''
+    INSERT INTO transacciones (usuario_id, numero_control, pin, transaccion_id, monto)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SQL_INSERT_PIN_FREEFIRE = 'INSERT INTO pines_freefire (monto_id, pin_codigo) VALUES (?, ?)'
+SQL_INSERT_PIN_FREEFIRE_GLOBAL = 'INSERT INTO pines_freefire_global (monto_id, pin_codigo) VALUES (?, ?)'
+SQL_GET_TX_COUNT = 'SELECT tx_count FROM usuarios WHERE id = ?'
+SQL_PRUNE_TRANSACTIONS = '''
+    DELETE FROM transacciones 
+    WHERE id IN (
+        SELECT id FROM transacciones 
+        WHERE usuario_id = ? 
+        ORDER BY fecha DESC 
+        LIMIT -1 OFFSET ?
+    )
+'''
+
+# Memoria de SQLite por conexión (ajustable según el plan del servidor): cada worker puede
+# tener hasta DB_POOL_SIZE conexiones abiertas, cada una con su propio cache de páginas
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 20000))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))
+
 def get_db_connection_optimized():
     """Obtiene una conexión optimizada con configuraciones SQLite mejoradas"""
-    conn = sqlite3.connect(DATABASE, timeout=20.0)
+    # cached_statements amplía el cache de sentencias preparadas (por defecto 128) para
+    # que las sentencias SQL_* de la compra no salgan del cache por las del panel admin
+    # isolation_level=None: autocommit; las escrituras de varias sentencias abren su
+    # transacción explícitamente con begin_write() (BEGIN IMMEDIATE)
+    # check_same_thread=False: las conexiones del pool pueden pasar de un hilo a otro entre
+    # peticiones (nunca se usan desde dos hilos a la vez)
+    conn = sqlite3.connect(DATABASE, timeout=20.0, cached_statements=512, isolation_level=None,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
-    # Optimizaciones SQLite para mejor rendimiento
-    conn.execute('PRAGMA journal_mode=WAL')
-    conn.execute('PRAGMA synchronous=NORMAL')
-    conn.execute('PRAGMA cache_size=10000')
+    # Optimizaciones SQLite para mejor rendimiento (una sola vez al abrir la conexión);
+    # journal_mode=WAL queda guardado en el archivo y se activa al arrancar en
+    # ensure_db_initialized(), timeout=20.0 ya fija el busy_timeout
+    conn.execute('PRAGMA synchronous=NORMAL')  # Con WAL evita un fsync por cada commit
+    conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_KB}')  # ~20 MB de cache de páginas por defecto
     conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')  # 256 MB de lectura mapeada por defecto
     return conn
 
 def return_db_connection(conn):
-    """Cierra la conexión (sin pool para evitar problemas de threading)"""
+    """Cierra una conexión de corta duración (init_db, diagnóstico al arrancar). No se
+    devuelve al pool: se abren antes de que gunicorn haga fork y una conexión SQLite no
+    debe heredarse entre procesos. Las peticiones usan get_db()/close_db()."""
     conn.close()
 
-def init_db():
-    """Inicializa la base de datos con las tablas necesarias - Compatible con Render"""
+# Versión del esquema guardada en PRAGMA user_version; incrementarla cuando init_db
+# agregue tablas, columnas o índices para que las bases existentes se actualicen al arrancar
+SCHEMA_VERSION = 6
+
+def init_db(skip_if_current=False):
+    """Inicializa la base de datos con las tablas necesarias - Compatible con Render.
+    Todo corre dentro de un único BEGIN IMMEDIATE. Con skip_if_current se vuelve a leer
+    user_version ya con el lock tomado: si varios workers arrancan a la vez, el primero migra
+    y los demás, que esperaban el lock, terminan sin repetir el DDL ni los seeds."""
     conn = None
     try:
         conn = get_db_connection_optimized()
+        begin_write(conn)
+        
+        if skip_if_current and conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            conn.rollback()
+            return
+        
         cursor = conn.cursor()
         
         # Tabla de usuarios
@@ -98,7 +203,8 @@ def init_db():
                 correo TEXT UNIQUE NOT NULL,
                 contraseña TEXT NOT NULL,
                 saldo REAL DEFAULT 0.0,
-                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
+                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP,
+                tx_count INTEGER DEFAULT 0
             )
         ''')
         
@@ -115,6 +221,36 @@ def init_db():
                 FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
             )
         ''')
+        
+        # Contador de transacciones por usuario (compatibilidad con bases de datos antiguas)
+        try:
+            cursor.execute('ALTER TABLE usuarios ADD COLUMN tx_count INTEGER DEFAULT 0')
+        except sqlite3.OperationalError:
+            pass  # La columna ya existe
+        
+        # Los triggers mantienen tx_count al día en cualquier INSERT o DELETE sobre
+        # transacciones (compras, limpieza diaria, borrado desde el admin)
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_transacciones_insert 
+            AFTER INSERT ON transacciones 
+            BEGIN 
+                UPDATE usuarios SET tx_count = tx_count + 1 WHERE id = NEW.usuario_id; 
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_transacciones_delete 
+            AFTER DELETE ON transacciones 
+            BEGIN 
+                UPDATE usuarios SET tx_count = tx_count - 1 WHERE id = OLD.usuario_id; 
+            END
+        ''')
+        
+        # Sincronizar el contador con el historial existente (bases creadas antes de los triggers)
+        cursor.execute('''
+            UPDATE usuarios SET tx_count = (
+                SELECT COUNT(*) FROM transacciones t WHERE t.usuario_id = usuarios.id
+            )
+        ''')
     
         # Tabla de pines de Free Fire LATAM
         cursor.execute('''
@@ -224,6 +360,29 @@ def init_db():
             )
         ''')
         
+        # Agregar columnas de créditos de billetera si no existen (compatibilidad con bases de datos antiguas)
+        for column_ddl in ('visto BOOLEAN DEFAULT FALSE', 'saldo_anterior REAL DEFAULT 0.0'):
+            try:
+                cursor.execute(f'ALTER TABLE creditos_billetera ADD COLUMN {column_ddl}')
+            except sqlite3.OperationalError:
+                pass  # La columna ya existe
+        
+        # Limitar los créditos de billetera a los 10 más recientes por usuario en la misma
+        # sentencia del INSERT (OFFSET recorre el índice usuario_id/fecha y solo toca las sobrantes)
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_creditos_billetera_limite 
+            AFTER INSERT ON creditos_billetera 
+            BEGIN 
+                DELETE FROM creditos_billetera 
+                WHERE id IN (
+                    SELECT id FROM creditos_billetera 
+                    WHERE usuario_id = NEW.usuario_id 
+                    ORDER BY fecha DESC, id DESC 
+                    LIMIT -1 OFFSET 10
+                ); 
+            END
+        ''')
+        
         # Tabla de noticias
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS noticias (
@@ -263,68 +422,60 @@ def init_db():
         ''')
         
         # Insertar configuración por defecto si no existe (todos en local)
-        cursor.execute('SELECT COUNT(*) FROM configuracion_fuentes_pines')
-        if cursor.fetchone()[0] == 0:
-            configuracion_default = [(i, 'local', True) for i in range(1, 10)]
-            cursor.executemany('''
-                INSERT INTO configuracion_fuentes_pines (monto_id, fuente, activo)
-                VALUES (?, ?, ?)
-            ''', configuracion_default)
+        configuracion_default = [(i, 'local', True) for i in range(1, 10)]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO configuracion_fuentes_pines (monto_id, fuente, activo)
+            VALUES (?, ?, ?)
+        ''', configuracion_default)
     
         # Insertar precios por defecto si no existen
-        cursor.execute('SELECT COUNT(*) FROM precios_paquetes')
-        if cursor.fetchone()[0] == 0:
-            precios_default = [
-                (1, '110 💎', 0.66, '110 Diamantes Free Fire', True),
-                (2, '341 💎', 2.25, '341 Diamantes Free Fire', True),
-                (3, '572 💎', 3.66, '572 Diamantes Free Fire', True),
-                (4, '1.166 💎', 7.10, '1.166 Diamantes Free Fire', True),
-                (5, '2.376 💎', 14.44, '2.376 Diamantes Free Fire', True),
-                (6, '6.138 💎', 33.10, '6.138 Diamantes Free Fire', True),
-                (7, 'Tarjeta básica', 0.50, 'Tarjeta básica Free Fire', True),
-                (8, 'Tarjeta semanal', 1.55, 'Tarjeta semanal Free Fire', True),
-                (9, 'Tarjeta mensual', 7.10, 'Tarjeta mensual Free Fire', True)
-            ]
-            cursor.executemany('''
-                INSERT INTO precios_paquetes (id, nombre, precio, descripcion, activo)
-                VALUES (?, ?, ?, ?, ?)
-            ''', precios_default)
+        precios_default = [
+            (1, '110 💎', 0.66, '110 Diamantes Free Fire', True),
+            (2, '341 💎', 2.25, '341 Diamantes Free Fire', True),
+            (3, '572 💎', 3.66, '572 Diamantes Free Fire', True),
+            (4, '1.166 💎', 7.10, '1.166 Diamantes Free Fire', True),
+            (5, '2.376 💎', 14.44, '2.376 Diamantes Free Fire', True),
+            (6, '6.138 💎', 33.10, '6.138 Diamantes Free Fire', True),
+            (7, 'Tarjeta básica', 0.50, 'Tarjeta básica Free Fire', True),
+            (8, 'Tarjeta semanal', 1.55, 'Tarjeta semanal Free Fire', True),
+            (9, 'Tarjeta mensual', 7.10, 'Tarjeta mensual Free Fire', True)
+        ]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO precios_paquetes (id, nombre, precio, descripcion, activo)
+            VALUES (?, ?, ?, ?, ?)
+        ''', precios_default)
         
         # Insertar precios de Blood Striker por defecto si no existen
-        cursor.execute('SELECT COUNT(*) FROM precios_bloodstriker')
-        if cursor.fetchone()[0] == 0:
-            precios_bloodstriker = [
-                (1, '100+16 🪙', 0.82, '100+16 Monedas Blood Striker', True),
-                (2, '300+52 🪙', 2.60, '300+52 Monedas Blood Striker', True),
-                (3, '500+94 🪙', 4.30, '500+94 Monedas Blood Striker', True),
-                (4, '1,000+210 🪙', 8.65, '1,000+210 Monedas Blood Striker', True),
-                (5, '2,000+486 🪙', 17.30, '2,000+486 Monedas Blood Striker', True),
-                (6, '5,000+1,380 🪙', 43.15, '5,000+1,380 Monedas Blood Striker', True),
-                (7, 'Pase Elite 🎖️', 3.50, 'Pase Elite Blood Striker', True),
-                (8, 'Pase Elite (Plus) 🎖️', 8.00, 'Pase Elite Plus Blood Striker', True),
-                (9, 'Pase de Mejora 🔫', 1.85, 'Pase de Mejora Blood Striker', True),
-                (10, 'Cofre Camuflaje Ultra 💼', 0.50, 'Cofre Camuflaje Ultra Blood Striker', True)
-            ]
-            cursor.executemany('''
-                INSERT INTO precios_bloodstriker (id, nombre, precio, descripcion, activo)
-                VALUES (?, ?, ?, ?, ?)
-            ''', precios_bloodstriker)
+        precios_bloodstriker = [
+            (1, '100+16 🪙', 0.82, '100+16 Monedas Blood Striker', True),
+            (2, '300+52 🪙', 2.60, '300+52 Monedas Blood Striker', True),
+            (3, '500+94 🪙', 4.30, '500+94 Monedas Blood Striker', True),
+            (4, '1,000+210 🪙', 8.65, '1,000+210 Monedas Blood Striker', True),
+            (5, '2,000+486 🪙', 17.30, '2,000+486 Monedas Blood Striker', True),
+            (6, '5,000+1,380 🪙', 43.15, '5,000+1,380 Monedas Blood Striker', True),
+            (7, 'Pase Elite 🎖️', 3.50, 'Pase Elite Blood Striker', True),
+            (8, 'Pase Elite (Plus) 🎖️', 8.00, 'Pase Elite Plus Blood Striker', True),
+            (9, 'Pase de Mejora 🔫', 1.85, 'Pase de Mejora Blood Striker', True),
+            (10, 'Cofre Camuflaje Ultra 💼', 0.50, 'Cofre Camuflaje Ultra Blood Striker', True)
+        ]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO precios_bloodstriker (id, nombre, precio, descripcion, activo)
+            VALUES (?, ?, ?, ?, ?)
+        ''', precios_bloodstriker)
         
         # Insertar precios de Free Fire Global por defecto si no existen
-        cursor.execute('SELECT COUNT(*) FROM precios_freefire_global')
-        if cursor.fetchone()[0] == 0:
-            precios_freefire_global = [
-                (1, '100+10 💎', 0.86, '100+10 Diamantes Free Fire', True),
-                (2, '310+31 💎', 2.90, '310+31 Diamantes Free Fire', True),
-                (3, '520+52 💎', 4.00, '520+52 Diamantes Free Fire', True),
-                (4, '1.060+106 💎', 7.75, '1.060+106 Diamantes Free Fire', True),
-                (5, '2.180+218 💎', 15.30, '2.180+218 Diamantes Free Fire', True),
-                (6, '5.600+560 💎', 38.00, '5.600+560 Diamantes Free Fire', True)
-            ]
-            cursor.executemany('''
-                INSERT INTO precios_freefire_global (id, nombre, precio, descripcion, activo)
-                VALUES (?, ?, ?, ?, ?)
-            ''', precios_freefire_global)
+        precios_freefire_global = [
+            (1, '100+10 💎', 0.86, '100+10 Diamantes Free Fire', True),
+            (2, '310+31 💎', 2.90, '310+31 Diamantes Free Fire', True),
+            (3, '520+52 💎', 4.00, '520+52 Diamantes Free Fire', True),
+            (4, '1.060+106 💎', 7.75, '1.060+106 Diamantes Free Fire', True),
+            (5, '2.180+218 💎', 15.30, '2.180+218 Diamantes Free Fire', True),
+            (6, '5.600+560 💎', 38.00, '5.600+560 Diamantes Free Fire', True)
+        ]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO precios_freefire_global (id, nombre, precio, descripcion, activo)
+            VALUES (?, ?, ?, ?, ?)
+        ''', precios_freefire_global)
         
         # Tabla de precios de compra (costos) para gestión de rentabilidad
         cursor.execute('''
@@ -358,48 +509,53 @@ def init_db():
         ''')
         
         # Insertar precios de compra por defecto si no existen
-        cursor.execute('SELECT COUNT(*) FROM precios_compra')
-        if cursor.fetchone()[0] == 0:
-            precios_compra_default = [
-                # Free Fire LATAM
-                ('freefire_latam', 1, 0.59),  # 110 💎 - costo $0.59, venta $0.66
-                ('freefire_latam', 2, 2.00),  # 341 💎 - costo $2.00, venta $2.25
-                ('freefire_latam', 3, 3.20),  # 572 💎 - costo $3.20, venta $3.66
-                ('freefire_latam', 4, 6.50),  # 1.166 💎 - costo $6.50, venta $7.10
-                ('freefire_latam', 5, 13.00), # 2.376 💎 - costo $13.00, venta $14.44
-                ('freefire_latam', 6, 30.00), # 6.138 💎 - costo $30.00, venta $33.10
-                ('freefire_latam', 7, 0.40),  # Tarjeta básica - costo $0.40, venta $0.50
-                ('freefire_latam', 8, 1.30),  # Tarjeta semanal - costo $1.30, venta $1.55
-                ('freefire_latam', 9, 6.50),  # Tarjeta mensual - costo $6.50, venta $7.10
-                
-                # Free Fire Global
-                ('freefire_global', 1, 0.75), # 100+10 💎 - costo $0.75, venta $0.86
-                ('freefire_global', 2, 2.50), # 310+31 💎 - costo $2.50, venta $2.90
-                ('freefire_global', 3, 3.50), # 520+52 💎 - costo $3.50, venta $4.00
-                ('freefire_global', 4, 7.00), # 1.060+106 💎 - costo $7.00, venta $7.75
-                ('freefire_global', 5, 14.00), # 2.180+218 💎 - costo $14.00, venta $15.30
-                ('freefire_global', 6, 35.00), # 5.600+560 💎 - costo $35.00, venta $38.00
-                
-                # Blood Striker
-                ('bloodstriker', 1, 0.70),   # 100+16 🪙 - costo $0.70, venta $0.82
-                ('bloodstriker', 2, 2.30),   # 300+52 🪙 - costo $2.30, venta $2.60
-                ('bloodstriker', 3, 3.80),   # 500+94 🪙 - costo $3.80, venta $4.30
-                ('bloodstriker', 4, 7.80),   # 1,000+210 🪙 - costo $7.80, venta $8.65
-                ('bloodstriker', 5, 15.50),  # 2,000+486 🪙 - costo $15.50, venta $17.30
-                ('bloodstriker', 6, 39.00),  # 5,000+1,380 🪙 - costo $39.00, venta $43.15
-                ('bloodstriker', 7, 3.00),   # Pase Elite - costo $3.00, venta $3.50
-                ('bloodstriker', 8, 7.20),   # Pase Elite Plus - costo $7.20, venta $8.00
-                ('bloodstriker', 9, 1.60),   # Pase de Mejora - costo $1.60, venta $1.85
-                ('bloodstriker', 10, 0.40),  # Cofre Camuflaje - costo $0.40, venta $0.50
-            ]
-            cursor.executemany('''
-                INSERT INTO precios_compra (juego, paquete_id, precio_compra)
-                VALUES (?, ?, ?)
-            ''', precios_compra_default)
+        precios_compra_default = [
+            # Free Fire LATAM
+            ('freefire_latam', 1, 0.59),  # 110 💎 - costo $0.59, venta $0.66
+            ('freefire_latam', 2, 2.00),  # 341 💎 - costo $2.00, venta $2.25
+            ('freefire_latam', 3, 3.20),  # 572 💎 - costo $3.20, venta $3.66
+            ('freefire_latam', 4, 6.50),  # 1.166 💎 - costo $6.50, venta $7.10
+            ('freefire_latam', 5, 13.00), # 2.376 💎 - costo $13.00, venta $14.44
+            ('freefire_latam', 6, 30.00), # 6.138 💎 - costo $30.00, venta $33.10
+            ('freefire_latam', 7, 0.40),  # Tarjeta básica - costo $0.40, venta $0.50
+            ('freefire_latam', 8, 1.30),  # Tarjeta semanal - costo $1.30, venta $1.55
+            ('freefire_latam', 9, 6.50),  # Tarjeta mensual - costo $6.50, venta $7.10
+            
+            # Free Fire Global
+            ('freefire_global', 1, 0.75), # 100+10 💎 - costo $0.75, venta $0.86
+            ('freefire_global', 2, 2.50), # 310+31 💎 - costo $2.50, venta $2.90
+            ('freefire_global', 3, 3.50), # 520+52 💎 - costo $3.50, venta $4.00
+            ('freefire_global', 4, 7.00), # 1.060+106 💎 - costo $7.00, venta $7.75
+            ('freefire_global', 5, 14.00), # 2.180+218 💎 - costo $14.00, venta $15.30
+            ('freefire_global', 6, 35.00), # 5.600+560 💎 - costo $35.00, venta $38.00
+            
+            # Blood Striker
+            ('bloodstriker', 1, 0.70),   # 100+16 🪙 - costo $0.70, venta $0.82
+            ('bloodstriker', 2, 2.30),   # 300+52 🪙 - costo $2.30, venta $2.60
+            ('bloodstriker', 3, 3.80),   # 500+94 🪙 - costo $3.80, venta $4.30
+            ('bloodstriker', 4, 7.80),   # 1,000+210 🪙 - costo $7.80, venta $8.65
+            ('bloodstriker', 5, 15.50),  # 2,000+486 🪙 - costo $15.50, venta $17.30
+            ('bloodstriker', 6, 39.00),  # 5,000+1,380 🪙 - costo $39.00, venta $43.15
+            ('bloodstriker', 7, 3.00),   # Pase Elite - costo $3.00, venta $3.50
+            ('bloodstriker', 8, 7.20),   # Pase Elite Plus - costo $7.20, venta $8.00
+            ('bloodstriker', 9, 1.60),   # Pase de Mejora - costo $1.60, venta $1.85
+            ('bloodstriker', 10, 0.40),  # Cofre Camuflaje - costo $0.40, venta $0.50
+        ]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO precios_compra (juego, paquete_id, precio_compra)
+            VALUES (?, ?, ?)
+        ''', precios_compra_default)
     
         # Crear índices optimizados para mejor rendimiento
         create_optimized_indexes(cursor)
         
+        # Actualizar las estadísticas del planificador para los índices nuevos (solo analiza
+        # las tablas que lo necesitan)
+        cursor.execute('PRAGMA optimize')
+        
+        # Marcar el esquema como actualizado
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        
         conn.commit()
         
     except Exception as e:
@@ -414,18 +570,48 @@ def init_db():
         if conn:
             return_db_connection(conn)
 
+def ensure_db_initialized():
+    """Ejecuta init_db solo si la base de datos no tiene el esquema actual.
+    Leer PRAGMA user_version es una lectura de la cabecera del archivo, así cada worker
+    de gunicorn arranca sin repetir todas las sentencias DDL ni tomar el lock de escritura.
+    También activa WAL (lectores no bloquean escritores); el modo es persistente en el
+    archivo, así que no hace falta repetirlo en cada conexión."""
+    conn = get_db_connection_optimized()
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        return_db_connection(conn)
+    
+    if version < SCHEMA_VERSION:
+        init_db(skip_if_current=True)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crea o actualiza el esquema de la base de datos (flask --app app init-db)"""
+    init_db()
+    print(f"Base de datos inicializada: {DATABASE}")
+
 def create_optimized_indexes(cursor):
     """Crea índices optimizados para consultas frecuentes"""
     indexes = [
-        'CREATE INDEX IF NOT EXISTS idx_usuarios_correo ON usuarios(correo)',
+        # correo es UNIQUE: SQLite ya mantiene un índice automático, uno más solo encarece los INSERT
+        'DROP INDEX IF EXISTS idx_usuarios_correo',
         'CREATE INDEX IF NOT EXISTS idx_transacciones_usuario_fecha ON transacciones(usuario_id, fecha DESC)',
         'CREATE INDEX IF NOT EXISTS idx_transacciones_fecha ON transacciones(fecha DESC)',
-        'CREATE INDEX IF NOT EXISTS idx_pines_monto_usado ON pines_freefire(monto_id, usado)',
-        'CREATE INDEX IF NOT EXISTS idx_pines_global_monto_usado ON pines_freefire_global(monto_id, usado)',
+        # Índices parciales: solo los pines disponibles, que son los únicos que se consultan
+        'DROP INDEX IF EXISTS idx_pines_monto_usado',
+        'DROP INDEX IF EXISTS idx_pines_global_monto_usado',
+        'CREATE INDEX IF NOT EXISTS idx_pines_disponibles ON pines_freefire(monto_id) WHERE usado = FALSE',
+        'CREATE INDEX IF NOT EXISTS idx_pines_global_disponibles ON pines_freefire_global(monto_id) WHERE usado = FALSE',
         'CREATE INDEX IF NOT EXISTS idx_ventas_semanales_juego_semana ON ventas_semanales(juego, semana_year)',
         'CREATE INDEX IF NOT EXISTS idx_precios_compra_juego_paquete ON precios_compra(juego, paquete_id, activo)',
         'CREATE INDEX IF NOT EXISTS idx_bloodstriker_estado ON transacciones_bloodstriker(estado, fecha DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_bloodstriker_usuario_estado ON transacciones_bloodstriker(usuario_id, estado, fecha DESC)',
         'CREATE INDEX IF NOT EXISTS idx_creditos_usuario_visto ON creditos_billetera(usuario_id, visto)',
+        'CREATE INDEX IF NOT EXISTS idx_creditos_usuario_fecha ON creditos_billetera(usuario_id, fecha DESC)',
+        # Listado y estadísticas de créditos del admin (ORDER BY fecha, créditos de hoy)
+        'CREATE INDEX IF NOT EXISTS idx_creditos_fecha ON creditos_billetera(fecha DESC)',
         'CREATE INDEX IF NOT EXISTS idx_noticias_fecha ON noticias(fecha DESC)'
     ]
     
@@ -436,133 +622,297 @@ def create_optimized_indexes(cursor):
             print(f"Error creando índice: {e}")
 
 # Cache en memoria para datos frecuentes
-@lru_cache(maxsize=128)
+# Tiempo de vida del cache de precios: los precios cambian poco y otros workers
+# solo ven las actualizaciones al expirar su propia copia
+PRICE_CACHE_TTL = int(os.environ.get('PRICE_CACHE_TTL', 300))
+# Usuarios y noticias del panel admin: unos segundos bastan para que recargar el panel
+# seguido no repita las lecturas completas; los saldos cambiados por compras pueden
+# mostrarse con ese retraso
+ADMIN_PANEL_CACHE_TTL = int(os.environ.get('ADMIN_PANEL_CACHE_TTL', 3))
+
+def ttl_cache(seconds):
+    """Cachea el resultado de una función sin argumentos durante `seconds` segundos.
+    Con varios hilos por worker, solo uno recarga el valor al expirar (los demás esperan
+    el lock y reutilizan el resultado en lugar de repetir la misma consulta)."""
+    def decorator(func):
+        state = {}
+        lock = threading.Lock()
+        
+        @wraps(func)
+        def wrapper():
+            # (valor, momento de carga) en una sola entrada para leerla sin lock
+            entry = state.get('entry')
+            if entry is not None and time.monotonic() - entry[1] <= seconds:
+                return entry[0]
+            with lock:
+                entry = state.get('entry')
+                if entry is None or time.monotonic() - entry[1] > seconds:
+                    entry = (func(), time.monotonic())
+                    state['entry'] = entry
+                return entry[0]
+        
+        wrapper.cache_clear = state.clear
+        return wrapper
+    return decorator
+
+def format_package_display(nombre, precio):
+    """Texto "nombre / $precio" que se muestra en selects, mensajes y compras"""
+    return f"{nombre} / ${precio:.2f}"
+
+# Cache compartido entre workers en Redis (solo si REDIS_URL está configurado).
+# El stock se ajusta con HINCRBY en cada compra o carga de pines; el TTL solo acota cuánto
+# puede durar una desviación si algún cambio no pasó por adjust_shared_counter()
+STOCK_CACHE_TTL = int(os.environ.get('STOCK_CACHE_TTL', 60))
+SHARED_PRICE_CACHE_TTL = int(os.environ.get('SHARED_PRICE_CACHE_TTL', 60))
+# Con Redis la copia local de los precios solo ahorra la ida a Redis en cada llamada: dura
+# unos segundos para que clear_price_cache() (que borra la clave compartida) llegue pronto a
+# los demás workers. Sin Redis cada worker se queda con su copia durante PRICE_CACHE_TTL.
+LOCAL_PRICE_CACHE_TTL = (min(PRICE_CACHE_TTL, int(os.environ.get('LOCAL_PRICE_CACHE_TTL', 5)))
+                         if redis_client is not None else PRICE_CACHE_TTL)
+CACHE_KEY_PREFIX = 'inefable:cache:'
+
+def shared_cache(key, seconds):
+    """Cachea en Redis durante `seconds` segundos el diccionario {id: valor} que devuelve una
+    función sin argumentos. Sin Redis (o si Redis falla) se llama directamente a la función."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper():
+            if redis_client is None:
+                return func()
+            try:
+                cached = redis_client.get(CACHE_KEY_PREFIX + key)
+                if cached is not None:
+                    # JSON convierte las claves a texto: restaurar los ids enteros
+                    return {int(k): v for k, v in json.loads(cached).items()}
+            except Exception as e:
+                print(f"Error leyendo cache compartido {key}: {e}")
+            
+            value = func()
+            try:
+                redis_client.setex(CACHE_KEY_PREFIX + key, seconds, json.dumps(value))
+            except Exception as e:
+                print(f"Error guardando cache compartido {key}: {e}")
+            return value
+        
+        wrapper.cache_key = key
+        return wrapper
+    return decorator
+
+def shared_counters(key, seconds):
+    """Como shared_cache, pero guarda el diccionario {id: entero} como un hash de Redis para
+    poder ajustar cada contador con adjust_shared_counter() sin volver a contar en SQLite."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper():
+            if redis_client is None:
+                return func()
+            try:
+                cached = redis_client.hgetall(CACHE_KEY_PREFIX + key)
+                if cached:
+                    return {int(k): int(v) for k, v in cached.items()}
+            except Exception as e:
+                print(f"Error leyendo contadores compartidos {key}: {e}")
+            
+            value = func()
+            if not value:
+                # HSET no acepta un mapping vacío (y un hash vacío no existe en Redis)
+                return value
+            try:
+                pipe = redis_client.pipeline()
+                pipe.hset(CACHE_KEY_PREFIX + key, mapping=value)
+                pipe.expire(CACHE_KEY_PREFIX + key, seconds)
+                pipe.execute()
+            except Exception as e:
+                print(f"Error guardando contadores compartidos {key}: {e}")
+            return value
+        
+        wrapper.cache_key = key
+        return wrapper
+    return decorator
+
+# HINCRBY solo si el hash existe: si no, la siguiente lectura lo recalcula completo desde
+# SQLite (un HINCRBY sobre un hash ausente crearía un stock con un solo monto)
+_ADJUST_COUNTER_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+return nil
+'''
+
+def adjust_shared_counter(key, field, delta):
+    """Suma `delta` al contador `field` del hash `key` después de un commit que cambió el stock"""
+    if redis_client is None or not delta:
+        return
+    try:
+        redis_client.eval(_ADJUST_COUNTER_SCRIPT, 1, CACHE_KEY_PREFIX + key, field, delta)
+    except Exception as e:
+        print(f"Error ajustando contador compartido {key}: {e}")
+        invalidate_shared_cache(key)
+
+def count_local_pins_taken(result):
+    """Cuántos pines del resultado de PinManager salieron del stock local (también en los
+    resultados parciales o de error que traen pines), para ajustar el stock compartido"""
+    if 'pin_code' in result:
+        return 1 if result.get('source') == 'local_stock' else 0
+    return sum(1 for pin in result.get('pins', []) if pin.get('source') == 'local_stock')
+
+def invalidate_shared_cache(*keys):
+    """Elimina claves del cache compartido para que la siguiente lectura vaya a la base de datos"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(*(CACHE_KEY_PREFIX + key for key in keys))
+    except Exception as e:
+        print(f"Error invalidando cache compartido {keys}: {e}")
+
+@ttl_cache(LOCAL_PRICE_CACHE_TTL)
+@shared_cache('prices:freefire_latam', SHARED_PRICE_CACHE_TTL)
 def get_package_info_with_prices_cached():
     """Versión cacheada de información de paquetes Free Fire LATAM"""
-    conn = get_db_connection_optimized()
-    try:
-        packages = conn.execute('''
-            SELECT id, nombre, precio, descripcion 
-            FROM precios_paquetes 
-            WHERE activo = TRUE 
-            ORDER BY id
-        ''').fetchall()
-        
-        package_dict = {}
-        for package in packages:
-            package_dict[package['id']] = {
-                'nombre': package['nombre'],
-                'precio': package['precio'],
-                'descripcion': package['descripcion']
-            }
-        return package_dict
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    packages = conn.execute('''
+        SELECT id, nombre, precio, descripcion 
+        FROM precios_paquetes 
+        WHERE activo = TRUE 
+        ORDER BY id
+    ''').fetchall()
+    
+    package_dict = {}
+    for package in packages:
+        package_dict[package['id']] = {
+            'nombre': package['nombre'],
+            'precio': package['precio'],
+            'descripcion': package['descripcion'],
+            'display': format_package_display(package['nombre'], package['precio'])
+        }
+    return package_dict
 
-@lru_cache(maxsize=128)
+@ttl_cache(LOCAL_PRICE_CACHE_TTL)
+@shared_cache('prices:bloodstriker', SHARED_PRICE_CACHE_TTL)
 def get_bloodstriker_prices_cached():
     """Versión cacheada de precios de Blood Striker"""
-    conn = get_db_connection_optimized()
-    try:
-        packages = conn.execute('''
-            SELECT id, nombre, precio, descripcion 
-            FROM precios_bloodstriker 
-            WHERE activo = TRUE 
-            ORDER BY id
-        ''').fetchall()
-        
-        package_dict = {}
-        for package in packages:
-            package_dict[package['id']] = {
-                'nombre': package['nombre'],
-                'precio': package['precio'],
-                'descripcion': package['descripcion']
-            }
-        return package_dict
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    packages = conn.execute('''
+        SELECT id, nombre, precio, descripcion 
+        FROM precios_bloodstriker 
+        WHERE activo = TRUE 
+        ORDER BY id
+    ''').fetchall()
+    
+    package_dict = {}
+    for package in packages:
+        package_dict[package['id']] = {
+            'nombre': package['nombre'],
+            'precio': package['precio'],
+            'descripcion': package['descripcion'],
+            'display': format_package_display(package['nombre'], package['precio'])
+        }
+    return package_dict
 
-@lru_cache(maxsize=128)
+@ttl_cache(LOCAL_PRICE_CACHE_TTL)
+@shared_cache('prices:freefire_global', SHARED_PRICE_CACHE_TTL)
 def get_freefire_global_prices_cached():
     """Versión cacheada de precios de Free Fire Global"""
-    conn = get_db_connection_optimized()
-    try:
-        packages = conn.execute('''
-            SELECT id, nombre, precio, descripcion 
-            FROM precios_freefire_global 
-            WHERE activo = TRUE 
-            ORDER BY id
-        ''').fetchall()
-        
-        package_dict = {}
-        for package in packages:
-            package_dict[package['id']] = {
-                'nombre': package['nombre'],
-                'precio': package['precio'],
-                'descripcion': package['descripcion']
-            }
-        return package_dict
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    packages = conn.execute('''
+        SELECT id, nombre, precio, descripcion 
+        FROM precios_freefire_global 
+        WHERE activo = TRUE 
+        ORDER BY id
+    ''').fetchall()
+    
+    package_dict = {}
+    for package in packages:
+        package_dict[package['id']] = {
+            'nombre': package['nombre'],
+            'precio': package['precio'],
+            'descripcion': package['descripcion'],
+            'display': format_package_display(package['nombre'], package['precio'])
+        }
+    return package_dict
 
 def clear_price_cache():
     """Limpia el cache de precios cuando se actualizan"""
     get_package_info_with_prices_cached.cache_clear()
     get_bloodstriker_prices_cached.cache_clear()
     get_freefire_global_prices_cached.cache_clear()
-
-@lru_cache(maxsize=1000)
-def convert_to_venezuela_time_cached(utc_datetime_str):
-    """Versión optimizada con cache de conversión de zona horaria"""
-    try:
-        utc_dt = datetime.strptime(utc_datetime_str, '%Y-%m-%d %H:%M:%S')
-        utc_dt = pytz.utc.localize(utc_dt)
-        venezuela_tz = pytz.timezone('America/Caracas')
-        venezuela_dt = utc_dt.astimezone(venezuela_tz)
-        return venezuela_dt.strftime('%Y-%m-%d %H:%M:%S')
-    except:
-        return utc_datetime_str
+    get_all_prices.cache_clear()
+    get_all_bloodstriker_prices.cache_clear()
+    get_all_freefire_global_prices.cache_clear()
+    get_package_name_lookup.cache_clear()
+    invalidate_shared_cache(
+        get_package_info_with_prices_cached.cache_key,
+        get_bloodstriker_prices_cached.cache_key,
+        get_freefire_global_prices_cached.cache_key
+    )
 
 # Funciones de stock optimizadas
 def get_pin_stock_optimized():
     """Versión optimizada que usa una sola query en lugar de 9"""
-    conn = get_db_connection_optimized()
-    try:
-        results = conn.execute('''
-            SELECT monto_id, COUNT(*) as count 
-            FROM pines_freefire 
-            WHERE usado = FALSE 
-            GROUP BY monto_id
-        ''').fetchall()
-        
-        stock = {i: 0 for i in range(1, 10)}
-        for result in results:
-            stock[result['monto_id']] = result['count']
-        return stock
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    results = conn.execute('''
+        SELECT monto_id, COUNT(*) as count 
+        FROM pines_freefire 
+        WHERE usado = FALSE 
+        GROUP BY monto_id
+    ''').fetchall()
+    
+    stock = {i: 0 for i in range(1, 10)}
+    for result in results:
+        stock[result['monto_id']] = result['count']
+    return stock
 
 def get_pin_stock_freefire_global_optimized():
     """Versión optimizada para Free Fire Global"""
-    conn = get_db_connection_optimized()
-    try:
-        results = conn.execute('''
-            SELECT monto_id, COUNT(*) as count 
-            FROM pines_freefire_global 
-            WHERE usado = FALSE 
-            GROUP BY monto_id
-        ''').fetchall()
-        
-        stock = {i: 0 for i in range(1, 7)}
-        for result in results:
-            stock[result['monto_id']] = result['count']
-        return stock
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    results = conn.execute('''
+        SELECT monto_id, COUNT(*) as count 
+        FROM pines_freefire_global 
+        WHERE usado = FALSE 
+        GROUP BY monto_id
+    ''').fetchall()
+    
+    stock = {i: 0 for i in range(1, 7)}
+    for result in results:
+        stock[result['monto_id']] = result['count']
+    return stock
+
+def get_all_pin_stock():
+    """Stock de Free Fire LATAM y Free Fire Global para el panel admin en una sola consulta.
+    Retorna (stock_latam, stock_global) con el mismo formato que las funciones de arriba."""
+    conn = get_db()
+    results = conn.execute('''
+        SELECT 'latam' AS juego, monto_id, COUNT(*) as count 
+        FROM pines_freefire 
+        WHERE usado = FALSE 
+        GROUP BY monto_id
+        UNION ALL
+        SELECT 'global' AS juego, monto_id, COUNT(*) as count 
+        FROM pines_freefire_global 
+        WHERE usado = FALSE 
+        GROUP BY monto_id
+    ''').fetchall()
+    
+    stock = {'latam': {i: 0 for i in range(1, 10)}, 'global': {i: 0 for i in range(1, 7)}}
+    for result in results:
+        stock[result['juego']][result['monto_id']] = result['count']
+    return stock['latam'], stock['global']
+
+# Método de hash de contraseñas: PBKDF2 con iteraciones calibradas para que un login
+# no bloquee el worker cientos de milisegundos (el valor por defecto de Werkzeug es 600000)
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:200000')
+# Prefijo que Werkzeug guarda realmente para ese método ('scrypt' se guarda como
+# 'scrypt:32768:8:1', 'pbkdf2:sha256' con sus iteraciones por defecto): se obtiene una vez
+# hasheando un valor cualquiera para comparar los hashes almacenados contra él
+_PASSWORD_HASH_PREFIX = generate_password_hash('', method=PASSWORD_HASH_METHOD).split('$', 1)[0]
 
 def hash_password(password):
     """Hashea la contraseña usando Werkzeug (más seguro que SHA256)"""
-    return generate_password_hash(password, method='pbkdf2:sha256', salt_length=16)
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=16)
+
+def password_needs_rehash(hashed):
+    """Indica si el hash no usa el método/iteraciones actuales y debe regenerarse"""
+    return hashed.split('$', 1)[0] != _PASSWORD_HASH_PREFIX
 
 def verify_password(password, hashed):
     """Verifica la contraseña hasheada (compatible con métodos antiguos y nuevos)"""
@@ -571,45 +921,80 @@ def verify_password(password, hashed):
         return check_password_hash(hashed, password)
     
     # Si no es un hash de Werkzeug, verificar con SHA256 (método anterior)
-    sha256_hash = hashlib.sha256(password.encode()).hexdigest()
-    return hashed == sha256_hash
+    # comparando los digests crudos en tiempo constante
+    if len(hashed) != 64:
+        return False
+    try:
+        expected = bytes.fromhex(hashed)
+    except ValueError:
+        return False
+    return hmac.compare_digest(hashlib.sha256(password.encode()).digest(), expected)
 
 
 def get_db_connection():
-    """Obtiene una conexión a la base de datos"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Obtiene una conexión a la base de datos (con las optimizaciones de SQLite aplicadas)"""
+    return get_db_connection_optimized()
+
+# Pool de conexiones del proceso: al reutilizarlas entre peticiones se conservan el cache
+# de páginas y el de sentencias preparadas, y se evita reabrir y reaplicar los PRAGMA
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
 
-def convert_to_venezuela_time(utc_datetime_str):
-    """Convierte una fecha UTC a la zona horaria de Venezuela (UTC-4)"""
+def acquire_db_connection():
+    """Toma una conexión libre del pool o abre una nueva si no hay"""
     try:
-        # Parsear la fecha UTC desde la base de datos
-        utc_dt = datetime.strptime(utc_datetime_str, '%Y-%m-%d %H:%M:%S')
-        
-        # Establecer como UTC
-        utc_dt = pytz.utc.localize(utc_dt)
-        
-        # Convertir a zona horaria de Venezuela (UTC-4)
-        venezuela_tz = pytz.timezone('America/Caracas')
-        venezuela_dt = utc_dt.astimezone(venezuela_tz)
-        
-        # Retornar en formato legible
-        return venezuela_dt.strftime('%Y-%m-%d %H:%M:%S')
-    except:
-        # Si hay error, retornar la fecha original
-        return utc_datetime_str
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return get_db_connection()
+
+def release_db_connection(conn):
+    """Devuelve una conexión al pool (la cierra si el pool está lleno)"""
+    try:
+        # Nunca devolver una conexión con una transacción a medias
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+
+def get_db():
+    """Obtiene la conexión de la petición actual (una sola conexión del pool por petición)"""
+    if not has_app_context():
+        # Fuera de una petición (scripts, pruebas) usar una conexión independiente
+        return get_db_connection()
+    if 'db' not in g:
+        g.db = acquire_db_connection()
+    return g.db
+
+def begin_write(conn):
+    """Inicia una transacción de escritura tomando el lock de escritura desde el principio
+    (BEGIN IMMEDIATE), en lugar de subir de lectura a escritura a mitad de la transacción,
+    que es la causa principal de SQLITE_BUSY con varios workers. Si ya hay una
+    transacción abierta en la conexión se reutiliza."""
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+
+@app.teardown_appcontext
+def close_db(exception):
+    """Devuelve la conexión de la petición al pool al finalizar el contexto de la aplicación"""
+    db = g.pop('db', None)
+    if db is not None:
+        release_db_connection(db)
+
+# Venezuela usa UTC-4 fijo (sin horario de verano): las consultas convierten la fecha
+# en SQLite con strftime(..., fecha, VENEZUELA_UTC_OFFSET) en lugar de fila por fila
+VENEZUELA_UTC_OFFSET = '-4 hours'
+VENEZUELA_TZ = pytz.timezone('America/Caracas')
 
 def get_user_by_email(email):
     """Obtiene un usuario por su email"""
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM usuarios WHERE correo = ?', (email,)).fetchone()
-    conn.close()
+    conn = get_db()
+    user = conn.execute(SQL_GET_USER_BY_EMAIL, (email,)).fetchone()
     return user
 
 def create_user(nombre, apellido, telefono, correo, contraseña):
     """Crea un nuevo usuario en la base de datos"""
-    conn = get_db_connection()
+    conn = get_db()
     hashed_password = hash_password(contraseña)
     try:
         cursor = conn.execute('''
@@ -618,59 +1003,179 @@ def create_user(nombre, apellido, telefono, correo, contraseña):
         ''', (nombre, apellido, telefono, correo, hashed_password, 0.0))
         user_id = cursor.lastrowid
         conn.commit()
-        conn.close()
+        get_all_users.cache_clear()
         return user_id
     except sqlite3.IntegrityError:
-        conn.close()
         return None
 
-def get_user_transactions(user_id, is_admin=False, page=1, per_page=10):
-    """Obtiene las transacciones de un usuario con información del paquete y paginación"""
-    conn = get_db_connection()
+def price_to_cents(precio):
+    """Convierte un precio a centavos enteros para compararlo sin errores de punto flotante"""
+    return int(round(abs(precio) * 100))
+
+def build_package_name_lookup(*packages_dicts):
+    """Construye un diccionario {centavos: nombre de paquete} a partir de diccionarios de precios.
+    
+    Los diccionarios se reciben en orden de prioridad: si dos paquetes tienen el mismo
+    precio se conserva el primero, igual que la búsqueda secuencial anterior.
+    """
+    lookup = {}
+    for packages_info in packages_dicts:
+        for package_info in packages_info.values():
+            lookup.setdefault(price_to_cents(package_info['precio']), package_info['nombre'])
+    return lookup
+
+@ttl_cache(LOCAL_PRICE_CACHE_TTL)
+def get_package_name_lookup():
+    """Índice {centavos: nombre} de Free Fire y Blood Striker (Free Fire tiene prioridad),
+    construido una vez por ciclo del cache de precios en lugar de en cada historial"""
+    return build_package_name_lookup(get_package_info_with_prices(), get_bloodstriker_prices())
+
+def prune_user_transactions(conn, user_id, keep):
+    """Elimina las transacciones más antiguas solo si el usuario supera las `keep`.
+    usuarios.tx_count lo mantienen los triggers de transacciones, así la comprobación es una
+    lectura por clave primaria y el DELETE solo corre cuando realmente sobra historial.
+    OFFSET recorre el índice (usuario_id, fecha) en lugar de materializar todo el historial.
+    Las compras del admin se registran con usuario_id 0, que no tiene fila en usuarios (ni
+    contador): en ese caso se ejecuta el DELETE directamente.
+    No hace commit: se ejecuta dentro de la transacción de la compra."""
+    counter = conn.execute(SQL_GET_TX_COUNT, (user_id,)).fetchone()
+    if counter is not None and counter['tx_count'] <= keep:
+        return
     
-    # Calcular offset para paginación
+    conn.execute(SQL_PRUNE_TRANSACTIONS, (user_id, keep))
+
+def debit_user_balance(conn, user_id, amount):
+    """Descuenta `amount` del saldo solo si alcanza y devuelve el saldo resultante, o None si
+    el saldo es insuficiente. Verificación y descuento van en una sola sentencia, así dos
+    compras simultáneas no pueden dejar el saldo en negativo.
+    No hace commit: se ejecuta dentro de la transacción de la compra."""
+    row = conn.execute(SQL_DEBIT_BALANCE, (amount, user_id, amount)).fetchone()
+    return row['saldo'] if row is not None else None
+
+def session_balance_covers(user_id, amount):
+    """Indica si el saldo alcanza para `amount` antes de iniciar una compra. Las páginas de
+    juegos no consultan el saldo en cada visita, así que si el saldo de la sesión no alcanza
+    (p. ej. el admin acaba de recargar) se relee de la base de datos antes de rechazar.
+    El descuento real lo valida debit_user_balance() dentro de la transacción."""
+    if session.get('saldo', 0) >= amount:
+        return True
+    user = get_db().execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()
+    if user is None:
+        return False
+    session['saldo'] = user['saldo']
+    return user['saldo'] >= amount
+
+def get_user_transactions(user_id, is_admin=False, page=1, per_page=10, include_pending_bloodstriker=False,
+                          user_totals=None):
+    """Obtiene las transacciones de un usuario con información del paquete y paginación.
+    Con include_pending_bloodstriker la primera página incluye también las solicitudes de
+    Blood Striker pendientes, mezcladas y ordenadas por fecha en la misma consulta.
+    user_totals es la fila (saldo, tx_count) del usuario si el llamador ya la leyó."""
+    conn = get_db()
+    
+    # Calcular offset para paginación (nunca negativo aunque llegue una página inválida)
+    page = max(page, 1)
     offset = (page - 1) * per_page
     
     if is_admin:
-        # Admin ve todas las transacciones de todos los usuarios
-        transactions = conn.execute('''
-            SELECT t.*, u.nombre, u.apellido
-            FROM transacciones t
-            JOIN usuarios u ON t.usuario_id = u.id
-            ORDER BY t.fecha DESC
-            LIMIT ? OFFSET ?
-        ''', (per_page, offset)).fetchall()
-        
-        # Obtener total de transacciones para paginación
-        total_count = conn.execute('''
-            SELECT COUNT(*) FROM transacciones t
-            JOIN usuarios u ON t.usuario_id = u.id
-        ''').fetchone()[0]
+        if include_pending_bloodstriker and page == 1:
+            # Últimas transacciones de todos los usuarios más todas las solicitudes pendientes
+            # de Blood Striker; la rama de transacciones se limita a per_page antes de unirlas
+            transactions = conn.execute('''
+                SELECT id, usuario_id, numero_control, pin, monto,
+                       strftime('%Y-%m-%d %H:%M:%S', fecha, ?) AS fecha, nombre, apellido,
+                       transaccion_id, paquete_nombre, estado, is_bloodstriker
+                FROM (
+                    SELECT * FROM (
+                        SELECT t.id, t.usuario_id, t.numero_control, t.pin, t.monto, t.fecha,
+                               u.nombre, u.apellido, NULL AS transaccion_id, NULL AS paquete_nombre,
+                               NULL AS estado, 0 AS is_bloodstriker
+                        FROM transacciones t
+                        JOIN usuarios u ON t.usuario_id = u.id
+                        ORDER BY t.fecha DESC
+                        LIMIT ?
+                    )
+                    UNION ALL
+                    SELECT bs.id, bs.usuario_id, bs.numero_control, 'ID: ' || bs.player_id, bs.monto, bs.fecha,
+                           u.nombre, u.apellido, bs.transaccion_id, p.nombre, bs.estado, 1
+                    FROM transacciones_bloodstriker bs
+                    JOIN usuarios u ON bs.usuario_id = u.id
+                    JOIN precios_bloodstriker p ON bs.paquete_id = p.id
+                    WHERE bs.estado = 'pendiente'
+                )
+                ORDER BY fecha DESC
+                LIMIT ?
+            ''', (VENEZUELA_UTC_OFFSET, per_page, per_page)).fetchall()
+        else:
+            # Admin ve todas las transacciones de todos los usuarios
+            transactions = conn.execute('''
+                SELECT t.id, t.usuario_id, t.numero_control, t.pin, t.monto,
+                       strftime('%Y-%m-%d %H:%M:%S', t.fecha, ?) AS fecha, u.nombre, u.apellido
+                FROM transacciones t
+                JOIN usuarios u ON t.usuario_id = u.id
+                ORDER BY t.fecha DESC
+                LIMIT ? OFFSET ?
+            ''', (VENEZUELA_UTC_OFFSET, per_page, offset)).fetchall()
+
+        # Total para paginación desde los contadores usuarios.tx_count que mantienen los triggers:
+        # se suma una fila por usuario en lugar de contar todo el historial (delete_user elimina
+        # las transacciones del usuario, así que no quedan huérfanas fuera de los contadores)
+        total_count = conn.execute('SELECT COALESCE(SUM(tx_count), 0) FROM usuarios').fetchone()[0]
+        saldo = 0  # Admin no tiene saldo
     else:
         # Usuario normal ve solo sus transacciones
-        if user_id:
+        if user_id and include_pending_bloodstriker and page == 1:
+            # Cada rama queda limitada a per_page antes de unirlas: SQLite solo ordena esas filas
             transactions = conn.execute('''
-                SELECT t.*, u.nombre, u.apellido
+                SELECT id, usuario_id, numero_control, pin, monto, 
+                       strftime('%Y-%m-%d %H:%M:%S', fecha, ?) AS fecha, nombre, apellido, 
+                       transaccion_id, paquete_nombre, estado, is_bloodstriker
+                FROM (
+                    SELECT * FROM (
+                        SELECT t.id, t.usuario_id, t.numero_control, t.pin, t.monto, t.fecha, 
+                               u.nombre, u.apellido, NULL AS transaccion_id, NULL AS paquete_nombre, 
+                               NULL AS estado, 0 AS is_bloodstriker
+                        FROM transacciones t
+                        JOIN usuarios u ON t.usuario_id = u.id
+                        WHERE t.usuario_id = ? 
+                        ORDER BY t.fecha DESC
+                        LIMIT ?
+                    )
+                    UNION ALL
+                    SELECT bs.id, bs.usuario_id, bs.numero_control, 'ID: ' || bs.player_id, bs.monto, bs.fecha, 
+                           u.nombre, u.apellido, bs.transaccion_id, p.nombre, bs.estado, 1
+                    FROM transacciones_bloodstriker bs
+                    JOIN usuarios u ON bs.usuario_id = u.id
+                    JOIN precios_bloodstriker p ON bs.paquete_id = p.id
+                    WHERE bs.usuario_id = ? AND bs.estado = 'pendiente'
+                )
+                ORDER BY fecha DESC
+                LIMIT ?
+            ''', (VENEZUELA_UTC_OFFSET, user_id, per_page, user_id, per_page)).fetchall()
+        elif user_id:
+            transactions = conn.execute('''
+                SELECT t.id, t.usuario_id, t.numero_control, t.pin, t.monto, 
+                       strftime('%Y-%m-%d %H:%M:%S', t.fecha, ?) AS fecha, u.nombre, u.apellido
                 FROM transacciones t
                 JOIN usuarios u ON t.usuario_id = u.id
                 WHERE t.usuario_id = ? 
                 ORDER BY t.fecha DESC
                 LIMIT ? OFFSET ?
-            ''', (user_id, per_page, offset)).fetchall()
-            
-            # Obtener total de transacciones del usuario para paginación
-            total_count = conn.execute('''
-                SELECT COUNT(*) FROM transacciones t
-                JOIN usuarios u ON t.usuario_id = u.id
-                WHERE t.usuario_id = ?
-            ''', (user_id,)).fetchone()[0]
+            ''', (VENEZUELA_UTC_OFFSET, user_id, per_page, offset)).fetchall()
+        
+        if user_id:
+            # Saldo actual y total de transacciones (contador tx_count que mantienen los
+            # triggers) en una lectura por clave primaria, sin contar el historial
+            totals = user_totals or conn.execute('SELECT saldo, tx_count FROM usuarios WHERE id = ?', (user_id,)).fetchone()
+            total_count = totals['tx_count'] if totals else 0
+            saldo = totals['saldo'] if totals else 0
         else:
             transactions = []
             total_count = 0
+            saldo = 0
     
-    # Obtener precios dinámicos de la base de datos (Free Fire y Blood Striker)
-    packages_info = get_package_info_with_prices()
-    bloodstriker_packages_info = get_bloodstriker_prices()
+    # Índice {centavos: nombre} cacheado junto con los precios
+    package_names = get_package_name_lookup()
     
     # Agregar información del paquete basado en el monto dinámico
     transactions_with_package = []
@@ -678,35 +1183,16 @@ def get_user_transactions(user_id, is_admin=False, page=1, per_page=10):
         transaction_dict = dict(transaction)
         monto = abs(transaction['monto'])  # Usar valor absoluto para comparar
         
-        # Buscar el paquete que coincida con el monto (con tolerancia para decimales)
-        paquete_encontrado = False
-        
-        # Primero buscar en paquetes de Free Fire
-        for package_id, package_info in packages_info.items():
-            if abs(monto - package_info['precio']) < 0.01:  # Tolerancia de 1 centavo
-                transaction_dict['paquete'] = package_info['nombre']
-                paquete_encontrado = True
-                break
-        
-        # Si no se encuentra en Free Fire, buscar en Blood Striker
-        if not paquete_encontrado:
-            for package_id, package_info in bloodstriker_packages_info.items():
-                if abs(monto - package_info['precio']) < 0.01:  # Tolerancia de 1 centavo
-                    transaction_dict['paquete'] = package_info['nombre']
-                    paquete_encontrado = True
-                    break
-        
-        # Si no se encuentra coincidencia exacta, usar el nombre por defecto
-        if not paquete_encontrado:
-            transaction_dict['paquete'] = f"Paquete ${monto:.2f}"
-        
-        # Convertir fecha a zona horaria de Venezuela
-        transaction_dict['fecha'] = convert_to_venezuela_time(transaction_dict['fecha'])
+        # Las solicitudes de Blood Striker traen su paquete; para el resto buscar el paquete que
+        # coincida con el monto o usar el nombre por defecto
+        # (la fecha ya viene convertida a la hora de Venezuela desde la consulta)
+        if transaction_dict.pop('paquete_nombre', None):
+            transaction_dict['paquete'] = transaction['paquete_nombre']
+        else:
+            transaction_dict['paquete'] = package_names.get(price_to_cents(monto), f"Paquete ${monto:.2f}")
         
         transactions_with_package.append(transaction_dict)
     
-    conn.close()
-    
     # Calcular información de paginación
     total_pages = (total_count + per_page - 1) // per_page  # Redondear hacia arriba
     has_prev = page > 1
@@ -714,6 +1200,7 @@ def get_user_transactions(user_id, is_admin=False, page=1, per_page=10):
     
     return {
         'transactions': transactions_with_package,
+        'saldo': saldo,
         'pagination': {
             'page': page,
             'per_page': per_page,
@@ -727,57 +1214,25 @@ def get_user_transactions(user_id, is_admin=False, page=1, per_page=10):
     }
 
 def get_user_wallet_credits(user_id):
-    """Obtiene los créditos de billetera de un usuario"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS creditos_billetera (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            monto REAL DEFAULT 0.0,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            visto BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
-    credits = conn.execute('''
-        SELECT * FROM creditos_billetera 
-        WHERE usuario_id = ? 
-        ORDER BY fecha DESC
+    """Obtiene los créditos de billetera de un usuario junto con su saldo actual.
+    Retorna una tupla (créditos, saldo)."""
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT u.saldo AS saldo_actual, cb.* 
+        FROM usuarios u
+        LEFT JOIN creditos_billetera cb ON cb.usuario_id = u.id
+        WHERE u.id = ? 
+        ORDER BY cb.fecha DESC
     ''', (user_id,)).fetchall()
-    conn.close()
-    return credits
+    if not rows:
+        return [], 0
+    # Con LEFT JOIN un usuario sin créditos devuelve una fila con columnas nulas
+    credits = [row for row in rows if row['id'] is not None]
+    return credits, rows[0]['saldo_actual']
 
 def get_all_wallet_credits():
     """Obtiene todos los créditos de billetera del sistema para el admin"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS creditos_billetera (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            monto REAL DEFAULT 0.0,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            visto BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
-    # Agregar columna 'visto' si no existe (para compatibilidad con datos existentes)
-    try:
-        conn.execute('ALTER TABLE creditos_billetera ADD COLUMN visto BOOLEAN DEFAULT FALSE')
-        conn.commit()
-    except:
-        pass  # La columna ya existe
-    
-    # Agregar columna 'saldo_anterior' si no existe (para compatibilidad con datos existentes)
-    try:
-        conn.execute('ALTER TABLE creditos_billetera ADD COLUMN saldo_anterior REAL DEFAULT 0.0')
-        conn.commit()
-    except:
-        pass  # La columna ya existe
-    
+    conn = get_db()
     try:
         credits = conn.execute('''
             SELECT cb.*, u.nombre, u.apellido, u.correo 
@@ -790,24 +1245,11 @@ def get_all_wallet_credits():
         print(f"Error al obtener créditos de billetera: {e}")
         credits = []
     
-    conn.close()
     return credits
 
 def get_wallet_credits_stats():
     """Obtiene estadísticas de créditos de billetera para el admin"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS creditos_billetera (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            monto REAL DEFAULT 0.0,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            visto BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
+    conn = get_db()
     try:
         # Total de créditos agregados
         total_credits = conn.execute('''
@@ -818,7 +1260,7 @@ def get_wallet_credits_stats():
         today_credits = conn.execute('''
             SELECT COALESCE(SUM(monto), 0) as today_total 
             FROM creditos_billetera 
-            WHERE DATE(fecha) = DATE('now')
+            WHERE fecha >= DATE('now') AND fecha < DATE('now', '+1 day')
         ''').fetchone()['today_total']
         
         # Número de usuarios que han recibido créditos
@@ -826,7 +1268,6 @@ def get_wallet_credits_stats():
             SELECT COUNT(DISTINCT usuario_id) as count FROM creditos_billetera
         ''').fetchone()['count']
         
-        conn.close()
         return {
             'total_credits': total_credits,
             'today_credits': today_credits,
@@ -834,216 +1275,82 @@ def get_wallet_credits_stats():
         }
     except Exception as e:
         print(f"Error al obtener estadísticas de créditos: {e}")
-        conn.close()
         return {
             'total_credits': 0,
             'today_credits': 0,
             'users_with_credits': 0
         }
 
-def get_unread_wallet_credits_count(user_id):
-    """Obtiene si hay créditos de billetera no vistos (retorna 1 si hay, 0 si no hay)"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS creditos_billetera (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            monto REAL DEFAULT 0.0,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            visto BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
-    # Agregar columna 'visto' si no existe (para compatibilidad con datos existentes)
-    try:
-        conn.execute('ALTER TABLE creditos_billetera ADD COLUMN visto BOOLEAN DEFAULT FALSE')
-        conn.commit()
-    except:
-        pass  # La columna ya existe
-    
-    count = conn.execute('''
-        SELECT COUNT(*) FROM creditos_billetera 
-        WHERE usuario_id = ? AND (visto = FALSE OR visto IS NULL)
-    ''', (user_id,)).fetchone()[0]
-    conn.close()
-    
-    # Retornar 1 si hay créditos no vistos, 0 si no hay
-    return 1 if count > 0 else 0
-
 def mark_wallet_credits_as_read(user_id):
     """Marca todos los créditos de billetera como vistos"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS creditos_billetera (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            monto REAL DEFAULT 0.0,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            visto BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
-    # Agregar columna 'visto' si no existe
-    try:
-        conn.execute('ALTER TABLE creditos_billetera ADD COLUMN visto BOOLEAN DEFAULT FALSE')
-        conn.commit()
-    except:
-        pass  # La columna ya existe
-    
+    conn = get_db()
     conn.execute('''
         UPDATE creditos_billetera 
         SET visto = TRUE 
         WHERE usuario_id = ?
     ''', (user_id,))
     conn.commit()
-    conn.close()
 
 # Funciones para sistema de noticias
-def create_news_table():
-    """Crea la tabla de noticias si no existe"""
-    conn = get_db_connection()
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS noticias (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            titulo TEXT NOT NULL,
-            contenido TEXT NOT NULL,
-            importante BOOLEAN DEFAULT FALSE,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def create_news_views_table():
-    """Crea la tabla para rastrear noticias vistas por usuario"""
-    conn = get_db_connection()
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS noticias_vistas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            noticia_id INTEGER,
-            fecha_vista DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id),
-            FOREIGN KEY (noticia_id) REFERENCES noticias (id),
-            UNIQUE(usuario_id, noticia_id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
 def create_news(titulo, contenido, importante=False):
     """Crea una nueva noticia"""
-    create_news_table()
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.execute('''
         INSERT INTO noticias (titulo, contenido, importante)
         VALUES (?, ?, ?)
     ''', (titulo, contenido, importante))
     news_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+    get_all_news.cache_clear()
     return news_id
 
+@ttl_cache(ADMIN_PANEL_CACHE_TTL)
 def get_all_news():
     """Obtiene todas las noticias ordenadas por fecha (más recientes primero)"""
-    create_news_table()
-    conn = get_db_connection()
+    conn = get_db()
     news = conn.execute('''
         SELECT * FROM noticias 
         ORDER BY fecha DESC
     ''').fetchall()
-    conn.close()
     return news
 
 def get_user_news(user_id):
     """Obtiene las noticias para un usuario específico"""
-    create_news_table()
-    create_news_views_table()
-    conn = get_db_connection()
+    conn = get_db()
     news = conn.execute('''
         SELECT * FROM noticias 
         ORDER BY fecha DESC
         LIMIT 20
     ''').fetchall()
-    conn.close()
     return news
 
-def get_unread_news_count(user_id):
-    """Obtiene el número de noticias no leídas por un usuario"""
-    create_news_table()
-    create_news_views_table()
-    conn = get_db_connection()
-    
-    # Contar noticias que el usuario no ha visto
-    count = conn.execute('''
-        SELECT COUNT(*) FROM noticias n
-        WHERE n.id NOT IN (
-            SELECT nv.noticia_id FROM noticias_vistas nv 
-            WHERE nv.usuario_id = ?
-        )
-    ''', (user_id,)).fetchone()[0]
-    conn.close()
-    
-    # Retornar 1 si hay noticias no leídas, 0 si no hay
-    return 1 if count > 0 else 0
-
 def mark_news_as_read(user_id):
     """Marca todas las noticias como leídas para un usuario"""
-    create_news_table()
-    create_news_views_table()
-    conn = get_db_connection()
-    
-    # Obtener todas las noticias que el usuario no ha visto
-    unread_news = conn.execute('''
-        SELECT id FROM noticias 
-        WHERE id NOT IN (
-            SELECT noticia_id FROM noticias_vistas 
-            WHERE usuario_id = ?
-        )
-    ''', (user_id,)).fetchall()
-    
-    # Marcar como vistas
-    for news in unread_news:
-        conn.execute('''
-            INSERT OR IGNORE INTO noticias_vistas (usuario_id, noticia_id)
-            VALUES (?, ?)
-        ''', (user_id, news['id']))
+    conn = get_db()
     
+    # Marcar como vistas todas las noticias en una sola sentencia: UNIQUE(usuario_id, noticia_id)
+    # hace que OR IGNORE salte las que ya estaban vistas
+    conn.execute('''
+        INSERT OR IGNORE INTO noticias_vistas (usuario_id, noticia_id)
+        SELECT ?, id FROM noticias
+    ''', (user_id,))
     conn.commit()
-    conn.close()
 
 def delete_news(news_id):
     """Elimina una noticia y sus registros de vistas"""
-    conn = get_db_connection()
+    conn = get_db()
+    begin_write(conn)
     # Eliminar registros de vistas
     conn.execute('DELETE FROM noticias_vistas WHERE noticia_id = ?', (news_id,))
     # Eliminar noticia
     conn.execute('DELETE FROM noticias WHERE id = ?', (news_id,))
     conn.commit()
-    conn.close()
+    get_all_news.cache_clear()
 
 # Funciones para notificaciones personalizadas
 def create_personal_notification(user_id, titulo, mensaje, tipo='success'):
     """Crea una notificación personalizada para un usuario específico"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS notificaciones_personalizadas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            titulo TEXT NOT NULL,
-            mensaje TEXT NOT NULL,
-            tipo TEXT DEFAULT 'info',
-            visto BOOLEAN DEFAULT FALSE,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
+    conn = get_db()
     cursor = conn.execute('''
         INSERT INTO notificaciones_personalizadas (usuario_id, titulo, mensaje, tipo)
         VALUES (?, ?, ?, ?)
@@ -1051,88 +1358,104 @@ def create_personal_notification(user_id, titulo, mensaje, tipo='success'):
     
     notification_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     return notification_id
 
 def get_user_personal_notifications(user_id):
     """Obtiene las notificaciones personalizadas de un usuario"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS notificaciones_personalizadas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            titulo TEXT NOT NULL,
-            mensaje TEXT NOT NULL,
-            tipo TEXT DEFAULT 'info',
-            visto BOOLEAN DEFAULT FALSE,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
+    conn = get_db()
     notifications = conn.execute('''
         SELECT * FROM notificaciones_personalizadas 
         WHERE usuario_id = ? AND visto = FALSE
         ORDER BY fecha DESC
         LIMIT 10
     ''', (user_id,)).fetchall()
-    conn.close()
     return notifications
 
 def get_unread_personal_notifications_count(user_id):
     """Obtiene el número de notificaciones personalizadas no leídas"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS notificaciones_personalizadas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            titulo TEXT NOT NULL,
-            mensaje TEXT NOT NULL,
-            tipo TEXT DEFAULT 'info',
-            visto BOOLEAN DEFAULT FALSE,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
+    conn = get_db()
+    return conn.execute('''
+        SELECT EXISTS(
+            SELECT 1 FROM notificaciones_personalizadas 
+            WHERE usuario_id = ? AND visto = FALSE
         )
-    ''')
-    
-    count = conn.execute('''
-        SELECT COUNT(*) FROM notificaciones_personalizadas 
-        WHERE usuario_id = ? AND visto = FALSE
     ''', (user_id,)).fetchone()[0]
-    conn.close()
-    
-    return 1 if count > 0 else 0
+
+def get_unread_notification_flags(user_id, is_admin=False):
+    """Obtiene en una sola consulta si hay créditos de billetera, noticias y notificaciones
+    personalizadas sin ver (1 si hay, 0 si no hay); el admin no tiene cartera ni personalizadas"""
+    conn = get_db()
+    row = conn.execute('''
+        SELECT
+            CASE WHEN ? THEN 0 ELSE EXISTS(
+                SELECT 1 FROM creditos_billetera
+                WHERE usuario_id = ? AND (visto = FALSE OR visto IS NULL)
+            ) END AS billetera,
+            EXISTS(
+                SELECT 1 FROM noticias n
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM noticias_vistas nv
+                    WHERE nv.usuario_id = ? AND nv.noticia_id = n.id
+                )
+            ) AS noticias,
+            CASE WHEN ? THEN 0 ELSE EXISTS(
+                SELECT 1 FROM notificaciones_personalizadas
+                WHERE usuario_id = ? AND visto = FALSE
+            ) END AS personalizadas
+    ''', (is_admin, user_id, user_id, is_admin, user_id)).fetchone()
+    
+    return row['billetera'], row['noticias'], row['personalizadas']
+
+def get_index_state(user_id):
+    """Obtiene en una sola consulta lo que determina la página principal de un usuario:
+    saldo, contador y última transacción, solicitudes pendientes de Blood Striker e
+    indicadores de notificaciones sin ver. Sirve para el ETag de la página y sus
+    indicadores se reutilizan al renderizar."""
+    conn = get_db()
+    return conn.execute('''
+        SELECT
+            u.saldo,
+            u.tx_count,
+            (SELECT MAX(t.id) FROM transacciones t WHERE t.usuario_id = u.id) AS ultima_transaccion,
+            (SELECT COUNT(*) || '-' || COALESCE(MAX(bs.id), 0)
+             FROM transacciones_bloodstriker bs
+             WHERE bs.usuario_id = u.id AND bs.estado = 'pendiente') AS pendientes_bloodstriker,
+            EXISTS(
+                SELECT 1 FROM creditos_billetera
+                WHERE usuario_id = u.id AND (visto = FALSE OR visto IS NULL)
+            ) AS billetera,
+            EXISTS(
+                SELECT 1 FROM noticias n
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM noticias_vistas nv
+                    WHERE nv.usuario_id = u.id AND nv.noticia_id = n.id
+                )
+            ) AS noticias,
+            EXISTS(
+                SELECT 1 FROM notificaciones_personalizadas
+                WHERE usuario_id = u.id AND visto = FALSE
+            ) AS personalizadas
+        FROM usuarios u
+        WHERE u.id = ?
+    ''', (user_id,)).fetchone()
 
 def mark_personal_notifications_as_read(user_id):
     """Marca todas las notificaciones personalizadas como leídas y las elimina"""
-    conn = get_db_connection()
-    # Crear tabla si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS notificaciones_personalizadas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            titulo TEXT NOT NULL,
-            mensaje TEXT NOT NULL,
-            tipo TEXT DEFAULT 'info',
-            visto BOOLEAN DEFAULT FALSE,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
+    conn = get_db()
     # Eliminar todas las notificaciones del usuario (para que desaparezcan después de verlas)
     conn.execute('''
         DELETE FROM notificaciones_personalizadas 
         WHERE usuario_id = ?
     ''', (user_id,))
     conn.commit()
-    conn.close()
 
 
 # Función de debug para mostrar información de la base de datos
-def debug_database_info():
+# Contar los registros de cada tabla recorre las tablas completas: al arrancar cada worker
+# solo se listan las tablas, salvo que se pida el conteo (o con flask --app app db-info)
+DEBUG_DB_ROW_COUNTS = os.environ.get('DEBUG_DB_ROW_COUNTS', 'False').lower() in ('1', 'true')
+
+def debug_database_info(count_rows=False):
     """Muestra información de debug sobre la base de datos"""
     print("=" * 50)
     print("🔍 DEBUG: INFORMACIÓN DE BASE DE DATOS")
@@ -1160,6 +1483,9 @@ def debug_database_info():
             tables = cursor.fetchall()
             print(f"📊 Tablas encontradas ({len(tables)}):")
             for table in tables:
+                if not count_rows:
+                    print(f"   - {table[0]}")
+                    continue
                 # Contar registros en cada tabla
                 try:
                     count = cursor.execute(f"SELECT COUNT(*) FROM {table[0]}").fetchone()[0]
@@ -1188,9 +1514,22 @@ def debug_database_info():
     
     print("=" * 50)
 
-# Inicializar la base de datos al iniciar la aplicación
-debug_database_info()
-init_db()
+# Inicializar la base de datos al iniciar la aplicación (solo si el esquema no está al día)
+debug_database_info(count_rows=DEBUG_DB_ROW_COUNTS)
+ensure_db_initialized()
+
+@app.cli.command('db-info')
+def db_info_command():
+    """Muestra la información de debug de la base de datos con el conteo de registros"""
+    debug_database_info(count_rows=True)
+
+# Versión del código desplegado para el ETag de la página principal: tras un despliegue el
+# navegador no debe recibir 304 con el HTML anterior. Render expone el commit desplegado;
+# si no, se usa la fecha de modificación de app.py y de la plantilla
+INDEX_ETAG_VERSION = os.environ.get('APP_VERSION') or os.environ.get('RENDER_GIT_COMMIT') or '%d-%d' % (
+    os.path.getmtime(__file__),
+    os.path.getmtime(os.path.join(app.root_path, app.template_folder, 'index.html'))
+)
 
 @app.route('/')
 def index():
@@ -1212,68 +1551,65 @@ def index():
     transactions_data = {}
     is_admin = session.get('is_admin', False)
     
+    # Usuario normal: si nada cambió desde la última carga (mismo ETag) responder 304 sin
+    # consultar el historial ni renderizar. Con mensajes flash pendientes siempre se renderiza
+    # y no se envía ETag, para que el navegador no vuelva a mostrar esos mensajes.
+    state = None
+    etag = None
+    if not is_admin and 'user_db_id' in session:
+        state = get_index_state(session['user_db_id'])
+        if state is not None:
+            session['saldo'] = state['saldo']
+            if '_flashes' not in session:
+                etag = hashlib.sha1(repr((
+                    INDEX_ETAG_VERSION, tuple(state), page, user_id,
+                    session.get('nombre'), session.get('apellido'), session.get('usuario'),
+                    sorted(get_package_name_lookup().items())
+                )).encode()).hexdigest()
+                if etag in request.if_none_match:
+                    response = app.response_class(status=304)
+                    response.set_etag(etag)
+                    response.headers['Cache-Control'] = 'private, no-cache'
+                    return response
+    
     if is_admin:
-        # Admin ve todas las transacciones de todos los usuarios con paginación
-        transactions_data = get_user_transactions(None, is_admin=True, page=page, per_page=per_page)
-        
-        # Para admin, también agregar transacciones pendientes de Blood Striker solo en la primera página
-        if page == 1:
-            bloodstriker_transactions = get_pending_bloodstriker_transactions()
-            # Combinar transacciones normales con las de Blood Striker
-            all_transactions = list(transactions_data['transactions']) + list(bloodstriker_transactions)
-            # Ordenar por fecha
-            all_transactions.sort(key=lambda x: x.get('fecha', ''), reverse=True)
-            # Tomar solo las primeras per_page transacciones
-            transactions_data['transactions'] = all_transactions[:per_page]
+        # Admin ve todas las transacciones de todos los usuarios con paginación; en la primera
+        # página la consulta ya mezcla las solicitudes pendientes de Blood Striker
+        transactions_data = get_user_transactions(None, is_admin=True, page=page, per_page=per_page,
+                                                  include_pending_bloodstriker=True)
         
         balance = 0  # Admin no tiene saldo
     else:
         # Usuario normal ve solo sus transacciones
         if 'user_db_id' in session:
-            # Actualizar saldo desde la base de datos SIEMPRE
-            conn = get_db_connection()
-            user = conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (session['user_db_id'],)).fetchone()
-            if user:
-                session['saldo'] = user['saldo']
-                balance = user['saldo']
-            else:
-                balance = 0
-            conn.close()
-            
-            # Obtener transacciones normales del usuario con paginación
-            transactions_data = get_user_transactions(session['user_db_id'], is_admin=False, page=page, per_page=per_page)
-            
-            # Para usuario normal, también agregar transacciones pendientes de Blood Striker solo en la primera página
-            if page == 1:
-                user_bloodstriker_transactions = get_user_pending_bloodstriker_transactions(session['user_db_id'])
-                # Combinar transacciones normales con las de Blood Striker del usuario
-                all_user_transactions = list(transactions_data['transactions']) + list(user_bloodstriker_transactions)
-                # Ordenar por fecha
-                all_user_transactions.sort(key=lambda x: x.get('fecha', ''), reverse=True)
-                # Tomar solo las primeras per_page transacciones
-                transactions_data['transactions'] = all_user_transactions[:per_page]
+            # Transacciones del usuario con paginación (incluye el saldo actual); en la primera
+            # página la consulta ya mezcla las solicitudes pendientes de Blood Striker
+            transactions_data = get_user_transactions(session['user_db_id'], is_admin=False, page=page, per_page=per_page,
+                                                      include_pending_bloodstriker=True, user_totals=state)
+            balance = transactions_data['saldo']
+            session['saldo'] = balance
         else:
             balance = 0
             transactions_data = {'transactions': [], 'pagination': {'page': 1, 'total_pages': 0, 'has_prev': False, 'has_next': False}}
     
-    # Obtener contador de notificaciones de cartera para usuarios normales
+    # Contadores de notificaciones (cartera, noticias y personalizadas) en una sola consulta;
+    # el saldo ya viene en la consulta de totales de get_user_transactions. Para usuarios
+    # normales ya vienen en la consulta del ETag.
     wallet_notification_count = 0
-    if not is_admin and 'user_db_id' in session:
-        wallet_notification_count = get_unread_wallet_credits_count(session['user_db_id'])
-    
-    # Obtener contador de notificaciones de noticias
     news_notification_count = 0
     personal_notification_count = 0
-    if 'user_db_id' in session:
-        news_notification_count = get_unread_news_count(session['user_db_id'])
-        # Obtener contador de notificaciones personalizadas (solo para usuarios normales)
-        if not is_admin:
-            personal_notification_count = get_unread_personal_notifications_count(session['user_db_id'])
+    if state is not None:
+        wallet_notification_count = state['billetera']
+        news_notification_count = state['noticias']
+        personal_notification_count = state['personalizadas']
+    elif 'user_db_id' in session:
+        wallet_notification_count, news_notification_count, personal_notification_count = \
+            get_unread_notification_flags(session['user_db_id'], is_admin=is_admin)
     
     # Combinar notificaciones de noticias y personalizadas
     total_notification_count = news_notification_count + personal_notification_count
     
-    return render_template('index.html', 
+    response = app.make_response(render_template('index.html', 
                          user_id=user_id, 
                          balance=balance, 
                          transactions=transactions_data['transactions'],
@@ -1282,7 +1618,11 @@ def index():
                          wallet_notification_count=wallet_notification_count,
                          news_notification_count=news_notification_count,
                          personal_notification_count=personal_notification_count,
-                         total_notification_count=total_notification_count)
+                         total_notification_count=total_notification_count))
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/auth')
 def auth():
@@ -1316,15 +1656,14 @@ def login():
     user = get_user_by_email(correo)
     
     if user and verify_password(contraseña, user['contraseña']):
-        # Migrar contraseña antigua a nuevo formato si es necesario
-        if not user['contraseña'].startswith('pbkdf2:'):
-            # Actualizar contraseña al nuevo formato seguro
+        # Migrar contraseña antigua (SHA256 o PBKDF2 con otras iteraciones) al formato actual
+        if password_needs_rehash(user['contraseña']):
+            # Actualizar contraseña al formato actual
             new_hashed_password = hash_password(contraseña)
-            conn = get_db_connection()
+            conn = get_db()
             conn.execute('UPDATE usuarios SET contraseña = ? WHERE id = ?', 
                         (new_hashed_password, user['id']))
             conn.commit()
-            conn.close()
             print(f"Contraseña migrada para usuario: {user['correo']}")
         
         # Login exitoso
@@ -1379,152 +1718,144 @@ def register():
 
 
 # Funciones de administrador
+@ttl_cache(ADMIN_PANEL_CACHE_TTL)
 def get_all_users():
     """Obtiene todos los usuarios registrados"""
-    conn = get_db_connection()
-    users = conn.execute('SELECT * FROM usuarios ORDER BY fecha_registro DESC').fetchall()
-    conn.close()
+    conn = get_db()
+    # Solo las columnas que muestra el panel (nunca el hash de la contraseña)
+    users = conn.execute('''
+        SELECT id, nombre, apellido, correo, telefono, saldo, fecha_registro 
+        FROM usuarios 
+        ORDER BY fecha_registro DESC
+    ''').fetchall()
     return users
 
 def update_user_balance(user_id, new_balance):
     """Actualiza el saldo de un usuario"""
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('UPDATE usuarios SET saldo = ? WHERE id = ?', (new_balance, user_id))
     conn.commit()
-    conn.close()
+    get_all_users.cache_clear()
 
 def delete_user(user_id):
-    """Elimina un usuario y todos sus datos relacionados"""
-    conn = get_db_connection()
+    """Elimina un usuario y todos sus datos relacionados en una sola transacción"""
+    conn = get_db()
+    begin_write(conn)
     # Eliminar transacciones del usuario
     conn.execute('DELETE FROM transacciones WHERE usuario_id = ?', (user_id,))
+    conn.execute('DELETE FROM transacciones_bloodstriker WHERE usuario_id = ?', (user_id,))
     # Eliminar créditos de billetera del usuario
     conn.execute('DELETE FROM creditos_billetera WHERE usuario_id = ?', (user_id,))
+    # Eliminar noticias vistas y notificaciones del usuario
+    conn.execute('DELETE FROM noticias_vistas WHERE usuario_id = ?', (user_id,))
+    conn.execute('DELETE FROM notificaciones_personalizadas WHERE usuario_id = ?', (user_id,))
     # Eliminar usuario
     conn.execute('DELETE FROM usuarios WHERE id = ?', (user_id,))
     conn.commit()
-    conn.close()
+    get_all_users.cache_clear()
 
 def add_credit_to_user(user_id, amount):
     """Añade crédito al saldo de un usuario y registra en billetera"""
-    conn = get_db_connection()
-    
-    # Crear tabla de créditos de billetera si no existe
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS creditos_billetera (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER,
-            monto REAL DEFAULT 0.0,
-            saldo_anterior REAL DEFAULT 0.0,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-        )
-    ''')
-    
-    # Agregar columna 'saldo_anterior' si no existe (para compatibilidad con datos existentes)
-    try:
-        conn.execute('ALTER TABLE creditos_billetera ADD COLUMN saldo_anterior REAL DEFAULT 0.0')
-        conn.commit()
-    except:
-        pass  # La columna ya existe
-    
-    # Obtener saldo actual del usuario antes de agregar el crédito
-    user_data = conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()
-    saldo_anterior = user_data['saldo'] if user_data else 0.0
+    conn = get_db()
+    begin_write(conn)
     
-    # Actualizar saldo del usuario
-    conn.execute('UPDATE usuarios SET saldo = saldo + ? WHERE id = ?', (amount, user_id))
+    # Actualizar saldo y obtener el saldo anterior en la misma sentencia
+    user_data = conn.execute('UPDATE usuarios SET saldo = saldo + ? WHERE id = ? RETURNING saldo', (amount, user_id)).fetchone()
+    saldo_anterior = round(user_data['saldo'] - amount, 2) if user_data else 0.0
     
-    # Registrar en créditos de billetera (monto, fecha y saldo anterior)
+    # Registrar en créditos de billetera (monto, fecha y saldo anterior); el trigger
+    # trg_creditos_billetera_limite conserva solo los 10 más recientes del usuario
     conn.execute('''
         INSERT INTO creditos_billetera (usuario_id, monto, saldo_anterior)
         VALUES (?, ?, ?)
     ''', (user_id, amount, saldo_anterior))
     
-    # Limitar créditos de billetera a 10 por usuario - eliminar los más antiguos si hay más de 10
-    conn.execute('''
-        DELETE FROM creditos_billetera 
-        WHERE usuario_id = ? AND id NOT IN (
-            SELECT id FROM creditos_billetera 
-            WHERE usuario_id = ? 
-            ORDER BY fecha DESC 
-            LIMIT 10
-        )
-    ''', (user_id, user_id))
-    
     conn.commit()
-    conn.close()
+    get_all_users.cache_clear()
 
 # Funciones para pines de Free Fire
 def add_pin_freefire(monto_id, pin_codigo):
     """Añade un pin de Free Fire al stock"""
-    conn = get_db_connection()
-    conn.execute('''
-        INSERT INTO pines_freefire (monto_id, pin_codigo)
-        VALUES (?, ?)
-    ''', (monto_id, pin_codigo))
+    conn = get_db()
+    conn.execute(SQL_INSERT_PIN_FREEFIRE, (monto_id, pin_codigo))
     conn.commit()
-    conn.close()
+    adjust_shared_counter(get_pin_stock.cache_key, monto_id, 1)
 
 def add_pins_batch(monto_id, pins_list):
     """Añade múltiples pines de Free Fire al stock en lote"""
-    conn = get_db_connection()
+    # Solo agregar pines no vacíos
+    rows = [(monto_id, p.strip()) for p in pins_list if p.strip()]
+    conn = get_db()
     try:
-        for pin_codigo in pins_list:
-            pin_codigo = pin_codigo.strip()
-            if pin_codigo:  # Solo agregar si el pin no está vacío
-                conn.execute('''
-                    INSERT INTO pines_freefire (monto_id, pin_codigo)
-                    VALUES (?, ?)
-                ''', (monto_id, pin_codigo))
+        begin_write(conn)
+        # Un solo executemany dentro de una única transacción (un commit para todo el lote)
+        conn.executemany(SQL_INSERT_PIN_FREEFIRE, rows)
         conn.commit()
-        return len([p for p in pins_list if p.strip()])  # Retornar cantidad agregada
+        adjust_shared_counter(get_pin_stock.cache_key, monto_id, len(rows))
+        return len(rows)  # Retornar cantidad agregada
     except Exception as e:
         conn.rollback()
         raise e
-    finally:
-        conn.close()
 
+@shared_counters('pin_stock:freefire_latam', STOCK_CACHE_TTL)
 def get_pin_stock():
-    """Obtiene el stock de pines por monto_id"""
-    conn = get_db_connection()
-    stock = {}
-    for i in range(1, 10):  # monto_id del 1 al 9
-        count = conn.execute('''
-            SELECT COUNT(*) FROM pines_freefire 
-            WHERE monto_id = ? AND usado = FALSE
-        ''', (i,)).fetchone()[0]
-        stock[i] = count
-    conn.close()
-    return stock
+    """Obtiene el stock de pines por monto_id (una sola consulta GROUP BY)"""
+    return get_pin_stock_optimized()
+
 
-def get_available_pin(monto_id):
-    """Obtiene un pin disponible para el monto especificado"""
-    conn = get_db_connection()
-    pin = conn.execute('''
-        SELECT * FROM pines_freefire 
-        WHERE monto_id = ? AND usado = FALSE 
-        LIMIT 1
+def get_pin_source(conn, monto_id):
+    """Obtiene la fuente configurada (local o api_externa) para un monto usando la conexión dada"""
+    result = conn.execute('''
+        SELECT fuente FROM configuracion_fuentes_pines 
+        WHERE monto_id = ? AND activo = TRUE
     ''', (monto_id,)).fetchone()
-    conn.close()
-    return pin
+    return result['fuente'] if result else 'local'
+
+# Tablas de precios por juego (nombres fijos, nunca datos del usuario)
+_PRICE_TABLES = {
+    'freefire_latam': 'precios_paquetes',
+    'bloodstriker': 'precios_bloodstriker',
+    'freefire_global': 'precios_freefire_global',
+}
+
+def get_package_by_id(conn, juego, package_id):
+    """Lee id, nombre y precio de un paquete activo en la conexión dada. Las compras la llaman
+    dentro de su transacción para cobrar el precio vigente en la base de datos; los caches de
+    precios (por worker) solo se usan para mostrar y para el rechazo temprano."""
+    return conn.execute(f'''
+        SELECT id, nombre, precio FROM {_PRICE_TABLES[juego]}
+        WHERE id = ? AND activo = TRUE
+    ''', (package_id,)).fetchone()
 
+def claim_local_pins(conn, monto_id, cantidad):
+    """Toma y elimina hasta `cantidad` pines del stock local en una sola sentencia.
+    No hace commit: el llamador decide dentro de su transacción."""
+    rows = conn.execute('''
+        DELETE FROM pines_freefire 
+        WHERE id IN (
+            SELECT id FROM pines_freefire 
+            WHERE monto_id = ? AND usado = FALSE 
+            ORDER BY id 
+            LIMIT ?
+        )
+        RETURNING pin_codigo
+    ''', (monto_id, cantidad)).fetchall()
+    return [row['pin_codigo'] for row in rows]
 
 def get_all_pins():
     """Obtiene todos los pines para el admin"""
-    conn = get_db_connection()
+    conn = get_db()
     pins = conn.execute('''
-        SELECT p.*, u.nombre, u.apellido 
+        SELECT p.id, p.monto_id, p.pin_codigo, p.fecha_agregado, p.usuario_id, u.nombre, u.apellido 
         FROM pines_freefire p
         LEFT JOIN usuarios u ON p.usuario_id = u.id
         ORDER BY p.fecha_agregado DESC
     ''').fetchall()
-    conn.close()
     return pins
 
 def remove_duplicate_pins():
     """Elimina pines duplicados de la base de datos, manteniendo el más reciente de cada código"""
-    conn = get_db_connection()
+    conn = get_db()
     try:
         # Encontrar pines duplicados y eliminar los más antiguos
         duplicates_removed = conn.execute('''
@@ -1537,144 +1868,78 @@ def remove_duplicate_pins():
         ''').rowcount
         
         conn.commit()
+        invalidate_shared_cache(get_pin_stock.cache_key)
         return duplicates_removed
     except Exception as e:
         conn.rollback()
         raise e
-    finally:
-        conn.close()
 
 def get_duplicate_pins_count():
     """Obtiene el número de pines duplicados en la base de datos"""
-    conn = get_db_connection()
-    try:
-        # Contar pines duplicados
-        result = conn.execute('''
-            SELECT COUNT(*) - COUNT(DISTINCT pin_codigo || '-' || monto_id) as duplicates
-            FROM pines_freefire
-            WHERE usado = FALSE
-        ''').fetchone()
-        
-        return result[0] if result else 0
-    finally:
-        conn.close()
+    conn = get_db()
+    # Contar pines duplicados
+    result = conn.execute('''
+        SELECT COUNT(*) - COUNT(DISTINCT pin_codigo || '-' || monto_id) as duplicates
+        FROM pines_freefire
+        WHERE usado = FALSE
+    ''').fetchone()
+    
+    return result[0] if result else 0
 
 # Funciones para gestión de precios
+@ttl_cache(PRICE_CACHE_TTL)
 def get_all_prices():
     """Obtiene todos los precios de paquetes"""
-    conn = get_db_connection()
+    conn = get_db()
     prices = conn.execute('''
         SELECT * FROM precios_paquetes 
         ORDER BY id
     ''').fetchall()
-    conn.close()
     return prices
 
-def get_price_by_id(monto_id):
-    """Obtiene el precio de un paquete específico"""
-    conn = get_db_connection()
-    price = conn.execute('''
-        SELECT precio FROM precios_paquetes 
-        WHERE id = ? AND activo = TRUE
-    ''', (monto_id,)).fetchone()
-    conn.close()
-    return price['precio'] if price else 0
-
 def update_package_price(package_id, new_price):
-    """Actualiza el precio de un paquete"""
-    conn = get_db_connection_optimized()
-    try:
-        conn.execute('''
-            UPDATE precios_paquetes 
-            SET precio = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (new_price, package_id))
-        conn.commit()
-        # Limpiar cache después de actualizar precios
-        clear_price_cache()
-    finally:
-        return_db_connection(conn)
+    """Actualiza el precio de un paquete.
+    Retorna el nombre del paquete (RETURNING) o None si no existe."""
+    conn = get_db()
+    begin_write(conn)
+    package = conn.execute('''
+        UPDATE precios_paquetes 
+        SET precio = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
+        WHERE id = ?
+        RETURNING nombre
+    ''', (new_price, package_id)).fetchone()
+    conn.commit()
+    # Limpiar cache después de actualizar precios
+    clear_price_cache()
+    return package['nombre'] if package else None
 
 def update_package_name(package_id, new_name):
     """Actualiza el nombre de un paquete"""
-    conn = get_db_connection_optimized()
-    try:
-        conn.execute('''
-            UPDATE precios_paquetes 
-            SET nombre = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (new_name, package_id))
-        conn.commit()
-        # Limpiar cache después de actualizar nombres
-        clear_price_cache()
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    conn.execute('''
+        UPDATE precios_paquetes 
+        SET nombre = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
+        WHERE id = ?
+    ''', (new_name, package_id))
+    conn.commit()
+    # Limpiar cache después de actualizar nombres
+    clear_price_cache()
 
 def get_package_info_with_prices():
-    """Obtiene información de paquetes con precios dinámicos"""
-    conn = get_db_connection()
-    packages = conn.execute('''
-        SELECT id, nombre, precio, descripcion 
-        FROM precios_paquetes 
-        WHERE activo = TRUE 
-        ORDER BY id
-    ''').fetchall()
-    conn.close()
-    
-    # Convertir a diccionario para fácil acceso
-    package_dict = {}
-    for package in packages:
-        package_dict[package['id']] = {
-            'nombre': package['nombre'],
-            'precio': package['precio'],
-            'descripcion': package['descripcion']
-        }
-    
-    return package_dict
+    """Obtiene información de paquetes con precios dinámicos (cacheado en memoria con TTL)"""
+    return get_package_info_with_prices_cached()
 
 # Funciones para Blood Striker
 def get_bloodstriker_prices():
-    """Obtiene información de paquetes de Blood Striker con precios dinámicos"""
-    conn = get_db_connection()
-    packages = conn.execute('''
-        SELECT id, nombre, precio, descripcion 
-        FROM precios_bloodstriker 
-        WHERE activo = TRUE 
-        ORDER BY id
-    ''').fetchall()
-    conn.close()
-    
-    # Convertir a diccionario para fácil acceso
-    package_dict = {}
-    for package in packages:
-        package_dict[package['id']] = {
-            'nombre': package['nombre'],
-            'precio': package['precio'],
-            'descripcion': package['descripcion']
-        }
-    
-    return package_dict
-
-def get_bloodstriker_price_by_id(package_id):
-    """Obtiene el precio de un paquete específico de Blood Striker"""
-    conn = get_db_connection()
-    price = conn.execute('''
-        SELECT precio FROM precios_bloodstriker 
-        WHERE id = ? AND activo = TRUE
-    ''', (package_id,)).fetchone()
-    conn.close()
-    return price['precio'] if price else 0
+    """Obtiene información de paquetes de Blood Striker con precios dinámicos (cacheado en memoria con TTL)"""
+    return get_bloodstriker_prices_cached()
 
 def create_bloodstriker_transaction(user_id, player_id, package_id, precio):
     """Crea una transacción pendiente de Blood Striker"""
-    import random
-    import string
-    
     # Generar datos de la transacción
-    numero_control = ''.join(random.choices(string.digits, k=10))
-    transaccion_id = 'BS-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    numero_control, transaccion_id = generate_transaction_ids('BS')
     
-    conn = get_db_connection()
+    conn = get_db()
     try:
         # Insertar transacción pendiente
         cursor = conn.execute('''
@@ -1693,12 +1958,10 @@ def create_bloodstriker_transaction(user_id, player_id, package_id, precio):
     except Exception as e:
         conn.rollback()
         raise e
-    finally:
-        conn.close()
 
 def get_pending_bloodstriker_transactions():
     """Obtiene todas las transacciones pendientes de Blood Striker para el admin"""
-    conn = get_db_connection()
+    conn = get_db()
     transactions = conn.execute('''
         SELECT bs.*, u.nombre, u.apellido, u.correo, p.nombre as paquete_nombre
         FROM transacciones_bloodstriker bs
@@ -1727,117 +1990,106 @@ def get_pending_bloodstriker_transactions():
         }
         formatted_transactions.append(formatted_transaction)
     
-    conn.close()
-    return formatted_transactions
-
-def get_user_pending_bloodstriker_transactions(user_id):
-    """Obtiene las transacciones pendientes de Blood Striker de un usuario específico"""
-    conn = get_db_connection()
-    transactions = conn.execute('''
-        SELECT bs.*, u.nombre, u.apellido, p.nombre as paquete_nombre
-        FROM transacciones_bloodstriker bs
-        JOIN usuarios u ON bs.usuario_id = u.id
-        JOIN precios_bloodstriker p ON bs.paquete_id = p.id
-        WHERE bs.usuario_id = ? AND bs.estado = 'pendiente'
-        ORDER BY bs.fecha DESC
-    ''', (user_id,)).fetchall()
-    
-    # Formatear las transacciones de Blood Striker para que sean compatibles con el template
-    formatted_transactions = []
-    for transaction in transactions:
-        formatted_transaction = {
-            'id': transaction['id'],
-            'usuario_id': transaction['usuario_id'],
-            'numero_control': transaction['numero_control'],
-            'transaccion_id': transaction['transaccion_id'],
-            'monto': transaction['monto'],
-            'fecha': convert_to_venezuela_time(transaction['fecha']),  # Convertir a zona horaria de Venezuela
-            'nombre': transaction['nombre'],
-            'apellido': transaction['apellido'],
-            'paquete': transaction['paquete_nombre'],
-            'pin': f"ID: {transaction['player_id']}",  # Mostrar Player ID del usuario
-            'estado': transaction['estado'],
-            'is_bloodstriker': True  # Marcar como transacción de Blood Striker
-        }
-        formatted_transactions.append(formatted_transaction)
-    
-    conn.close()
     return formatted_transactions
 
 def update_bloodstriker_transaction_status(transaction_id, new_status, admin_id, notas=None):
     """Actualiza el estado de una transacción de Blood Striker"""
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         UPDATE transacciones_bloodstriker 
         SET estado = ?, admin_id = ?, notas = ?, fecha_procesado = CURRENT_TIMESTAMP
         WHERE id = ?
     ''', (new_status, admin_id, notas, transaction_id))
     conn.commit()
-    conn.close()
 
-def update_bloodstriker_price(package_id, new_price):
-    """Actualiza el precio de un paquete de Blood Striker"""
-    conn = get_db_connection_optimized()
+def reject_bloodstriker_transaction_with_refund(transaction_id, admin_id, notas=None):
+    """Rechaza una transacción pendiente de Blood Striker y devuelve el saldo al usuario en la
+    misma transacción. El UPDATE ... RETURNING cambia el estado y devuelve el usuario y el monto
+    en una sola sentencia; solo afecta transacciones pendientes, así rechazar dos veces no
+    devuelve el saldo dos veces. Retorna True si se rechazó, False si no estaba pendiente."""
+    conn = get_db()
     try:
-        conn.execute('''
-            UPDATE precios_bloodstriker 
-            SET precio = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (new_price, package_id))
+        begin_write(conn)
+        transaction = conn.execute('''
+            UPDATE transacciones_bloodstriker 
+            SET estado = 'rechazado', admin_id = ?, notas = ?, fecha_procesado = CURRENT_TIMESTAMP
+            WHERE id = ? AND estado = 'pendiente'
+            RETURNING usuario_id, monto
+        ''', (admin_id, notas, transaction_id)).fetchone()
+        
+        if transaction is None:
+            conn.rollback()
+            return False
+        
+        # Devolver saldo al usuario (monto es negativo, así que sumamos el valor absoluto)
+        conn.execute(SQL_CREDIT_BALANCE, (abs(transaction['monto']), transaction['usuario_id']))
         conn.commit()
-        # Limpiar cache después de actualizar precios
-        clear_price_cache()
-    finally:
-        return_db_connection(conn)
+        return True
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+def update_bloodstriker_price(package_id, new_price):
+    """Actualiza el precio de un paquete de Blood Striker.
+    Retorna el nombre del paquete (RETURNING) o None si no existe."""
+    conn = get_db()
+    begin_write(conn)
+    package = conn.execute('''
+        UPDATE precios_bloodstriker 
+        SET precio = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
+        WHERE id = ?
+        RETURNING nombre
+    ''', (new_price, package_id)).fetchone()
+    conn.commit()
+    # Limpiar cache después de actualizar precios
+    clear_price_cache()
+    return package['nombre'] if package else None
 
 def update_bloodstriker_name(package_id, new_name):
     """Actualiza el nombre de un paquete de Blood Striker"""
-    conn = get_db_connection_optimized()
-    try:
-        conn.execute('''
-            UPDATE precios_bloodstriker 
-            SET nombre = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (new_name, package_id))
-        conn.commit()
-        # Limpiar cache después de actualizar nombres
-        clear_price_cache()
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    conn.execute('''
+        UPDATE precios_bloodstriker 
+        SET nombre = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
+        WHERE id = ?
+    ''', (new_name, package_id))
+    conn.commit()
+    # Limpiar cache después de actualizar nombres
+    clear_price_cache()
 
+@ttl_cache(PRICE_CACHE_TTL)
 def get_all_bloodstriker_prices():
     """Obtiene todos los precios de paquetes de Blood Striker"""
-    conn = get_db_connection()
+    conn = get_db()
     prices = conn.execute('''
         SELECT * FROM precios_bloodstriker 
         ORDER BY id
     ''').fetchall()
-    conn.close()
     return prices
 
 # Funciones para configuración de fuentes de pines
 def get_pin_source_config():
-    """Obtiene la configuración de fuentes de pines por monto"""
-    conn = get_db_connection()
-    config = {}
-    for i in range(1, 10):
-        result = conn.execute('''
-            SELECT fuente FROM configuracion_fuentes_pines 
-            WHERE monto_id = ? AND activo = TRUE
-        ''', (i,)).fetchone()
-        config[i] = result['fuente'] if result else 'local'
-    conn.close()
+    """Obtiene la configuración de fuentes de pines por monto (una sola consulta)"""
+    conn = get_db()
+    results = conn.execute('''
+        SELECT monto_id, fuente FROM configuracion_fuentes_pines 
+        WHERE activo = TRUE
+    ''').fetchall()
+    
+    config = {i: 'local' for i in range(1, 10)}
+    for result in results:
+        if result['monto_id'] in config:
+            config[result['monto_id']] = result['fuente']
     return config
 
 def update_pin_source_config(monto_id, fuente):
     """Actualiza la configuración de fuente para un monto específico"""
-    conn = get_db_connection()
+    conn = get_db()
     conn.execute('''
         INSERT OR REPLACE INTO configuracion_fuentes_pines (monto_id, fuente, activo, fecha_actualizacion)
         VALUES (?, ?, TRUE, CURRENT_TIMESTAMP)
     ''', (monto_id, fuente))
     conn.commit()
-    conn.close()
 
 # Funciones de notificación por correo
 def send_email_async(app, msg):
@@ -1947,8 +2199,7 @@ def admin_panel():
         return redirect('/auth')
     
     users = get_all_users()
-    pin_stock = get_pin_stock_optimized()
-    pin_stock_freefire_global = get_pin_stock_freefire_global_optimized()
+    pin_stock, pin_stock_freefire_global = get_all_pin_stock()
     prices = get_all_prices()
     freefire_global_prices = get_all_freefire_global_prices()
     bloodstriker_prices = get_all_bloodstriker_prices()
@@ -1963,7 +2214,8 @@ def admin_panel():
                          freefire_global_prices=freefire_global_prices,
                          bloodstriker_prices=bloodstriker_prices,
                          pin_sources_config=pin_sources_config,
-                         noticias=noticias)
+                         noticias=noticias,
+                         max_pins_per_batch=MAX_PINS_PER_BATCH)
 
 @app.route('/admin/add_credit', methods=['POST'])
 def admin_add_credit():
@@ -2043,7 +2295,7 @@ def admin_add_pin():
             return redirect('/admin')
         
         if package_info:
-            paquete_nombre = f"{package_info['nombre']} / ${package_info['precio']:.2f}"
+            paquete_nombre = package_info['display']
         else:
             paquete_nombre = "Paquete desconocido"
         
@@ -2053,6 +2305,12 @@ def admin_add_pin():
     
     return redirect('/admin')
 
+# Separadores aceptados entre pines de un lote: coma, punto y coma, tabulación y saltos de línea
+_PIN_SPLIT = re.compile(r'[,;\t\r\n]+')
+# El lote se inserta con un solo executemany y un commit, así que el límite solo acota el
+# tamaño del formulario
+MAX_PINS_PER_BATCH = int(os.environ.get('MAX_PINS_PER_BATCH', 100))
+
 @app.route('/admin/add_pins_batch', methods=['POST'])
 def admin_add_pins_batch():
     if not session.get('is_admin'):
@@ -2067,17 +2325,18 @@ def admin_add_pins_batch():
         flash('Por favor complete todos los campos para el lote de pines', 'error')
         return redirect('/admin')
     
-    # Procesar los pines (separados por líneas o comas)
-    pins_list = []
-    for line in pins_text.replace(',', '\n').split('\n'):
-        pin = line.strip()
-        if pin:
-            pins_list.append(pin)
+    # Procesar los pines (separados por líneas, comas, punto y coma o tabulaciones)
+    pins_list = [p for p in (s.strip() for s in _PIN_SPLIT.split(pins_text)) if p]
     
     if not pins_list:
         flash('No se encontraron pines válidos en el texto', 'error')
         return redirect('/admin')
     
+    # Rechazar el lote completo: si se cortara, el admin tendría que averiguar qué pines faltan
+    if len(pins_list) > MAX_PINS_PER_BATCH:
+        flash(f'El lote tiene {len(pins_list)} pines y el máximo es {MAX_PINS_PER_BATCH}. No se agregó ningún pin: divida el lote e intente nuevamente.', 'error')
+        return redirect('/admin')
+    
     try:
         if game_type == 'freefire_latam':
             added_count = add_pins_batch(int(monto_id), pins_list)
@@ -2096,7 +2355,7 @@ def admin_add_pins_batch():
             return redirect('/admin')
         
         if package_info:
-            paquete_nombre = f"{package_info['nombre']} / ${package_info['precio']:.2f}"
+            paquete_nombre = package_info['display']
         else:
             paquete_nombre = "Paquete desconocido"
         
@@ -2143,18 +2402,13 @@ def admin_update_price():
             flash('El precio no puede ser negativo', 'error')
             return redirect('/admin')
         
-        # Obtener información del paquete antes de actualizar
-        conn = get_db_connection()
-        package = conn.execute('SELECT nombre FROM precios_paquetes WHERE id = ?', (package_id,)).fetchone()
-        conn.close()
-        
-        if not package:
+        # Actualizar precio; el UPDATE devuelve el nombre del paquete (None si no existe)
+        nombre = update_package_price(int(package_id), new_price)
+        if nombre is None:
             flash('Paquete no encontrado', 'error')
             return redirect('/admin')
         
-        # Actualizar precio
-        update_package_price(int(package_id), new_price)
-        flash(f'Precio actualizado exitosamente para {package["nombre"]}: ${new_price:.2f}', 'success')
+        flash(f'Precio actualizado exitosamente para {nombre}: ${new_price:.2f}', 'success')
         
     except ValueError:
         flash('Precio inválido. Debe ser un número válido.', 'error')
@@ -2187,9 +2441,8 @@ def admin_update_name():
             return redirect('/admin')
         
         # Obtener información del paquete antes de actualizar
-        conn = get_db_connection()
+        conn = get_db()
         package = conn.execute('SELECT nombre FROM precios_paquetes WHERE id = ?', (package_id,)).fetchone()
-        conn.close()
         
         if not package:
             flash('Paquete no encontrado', 'error')
@@ -2232,15 +2485,8 @@ def billetera():
         # Marcar todas las notificaciones de cartera como vistas
         mark_wallet_credits_as_read(user_id)
         
-        # Obtener créditos de billetera del usuario
-        wallet_credits = get_user_wallet_credits(user_id)
-        
-        # Actualizar saldo
-        conn = get_db_connection()
-        user = conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()
-        if user:
-            session['saldo'] = user['saldo']
-        conn.close()
+        # Obtener créditos de billetera y saldo actual del usuario
+        wallet_credits, session['saldo'] = get_user_wallet_credits(user_id)
         
         return render_template('billetera.html', 
                              wallet_credits=wallet_credits, 
@@ -2271,187 +2517,198 @@ def validar_freefire_latam():
         flash('La cantidad debe estar entre 1 y 10 pines', 'error')
         return redirect('/juego/freefire_latam')
     
-    # Obtener precio dinámico de la base de datos
-    precio_unitario = get_price_by_id(monto_id)
-    precio_total = precio_unitario * cantidad
-    
-    # Obtener información del paquete usando cache
-    packages_info = get_package_info_with_prices_cached()
-    package_info = packages_info.get(monto_id, {})
-    
-    paquete_nombre = f"{package_info.get('nombre', 'Paquete')} x{cantidad}"
-    
-    if precio_unitario == 0:
+    # Rechazo temprano con el cache de precios activos (el precio que se cobra se lee en la transacción)
+    package_info = get_package_info_with_prices_cached().get(monto_id)
+    if package_info is None:
         flash('Paquete no encontrado o inactivo', 'error')
         return redirect('/juego/freefire_latam')
     
-    saldo_actual = session.get('saldo', 0)
+    precio_unitario = package_info['precio']
+    precio_total = precio_unitario * cantidad
+    
+    paquete_nombre = f"{package_info['nombre']} x{cantidad}"
     
     # Solo verificar saldo para usuarios normales, admin puede comprar sin saldo
-    if not is_admin and saldo_actual < precio_total:
-        flash(f'Saldo insuficiente. Necesitas ${precio_total:.2f} pero tienes ${saldo_actual:.2f}', 'error')
+    if not is_admin and not session_balance_covers(user_id, precio_total):
+        flash(f'Saldo insuficiente. Necesitas ${precio_total:.2f} pero tienes ${session.get("saldo", 0):.2f}', 'error')
         return redirect('/juego/freefire_latam')
     
-    # CRÍTICO: Usar pin manager para obtener pines ANTES de descontar saldo
-    pin_manager = create_pin_manager(DATABASE)
+    conn = get_db()
+    usar_api_externa = get_pin_source(conn, monto_id) == 'api_externa'
+    pines_codigos = []
+    sources_used = ['local_stock']
     
     try:
-        # PASO 1: Intentar obtener los pines SIN descontar saldo aún
-        if cantidad == 1:
-            # Para un solo pin
-            result = pin_manager.request_pin(monto_id)
-            
-            if result.get('status') == 'success':
-                pines_codigos = [result.get('pin_code')]
-                sources_used = ['local_stock']
-            else:
-                flash('Sin stock disponible para este paquete.', 'error')
-                return redirect('/juego/freefire_latam')
-        else:
-            # Para múltiples pines
-            result = pin_manager.request_multiple_pins(monto_id, cantidad)
-            
-            if result.get('status') == 'success':
-                pines_data = result.get('pins', [])
-                pines_codigos = [pin['pin_code'] for pin in pines_data]
-                # Determinar fuentes usadas basado en el resultado
-                source = result.get('source', 'local_stock')
-                sources_used = [source]
-            elif result.get('status') == 'partial_success':
-                # Algunos pines obtenidos, pero no todos
-                pines_data = result.get('pins', [])
-                pines_codigos = [pin['pin_code'] for pin in pines_data]
-                source = result.get('source', 'local_stock')
-                sources_used = [source]
+        # PASO 1: Si la fuente es la API externa, obtener los pines ANTES de descontar saldo
+        if usar_api_externa:
+            pin_manager = create_pin_manager(DATABASE)
+            if cantidad == 1:
+                # Para un solo pin
+                result = pin_manager.request_pin(monto_id)
+                adjust_shared_counter(get_pin_stock.cache_key, monto_id, -count_local_pins_taken(result))
                 
-                # Actualizar cantidad y precio total para los pines realmente obtenidos
-                cantidad_original = cantidad
-                cantidad = len(pines_codigos)
-                precio_total = precio_unitario * cantidad  # Recalcular precio
-                
-                flash(f'Advertencia: Solo se obtuvieron {cantidad} pines de los {cantidad_original} solicitados. Precio ajustado a ${precio_total:.2f}', 'warning')
-            else:
-                flash(f'Error al obtener pines. {result.get("message", "Error desconocido")}', 'error')
-                return redirect('/juego/freefire_latam')
-        
-        # PASO 2: Verificar que se obtuvieron pines exitosamente
-        if not pines_codigos:
-            flash('No se pudieron obtener pines. Intente nuevamente.', 'error')
-            return redirect('/juego/freefire_latam')
-        
-        # PASO 3: AHORA SÍ verificar saldo final después de saber cuántos pines obtuvimos
-        if not is_admin and saldo_actual < precio_total:
-            flash(f'Saldo insuficiente para la cantidad obtenida. Necesitas ${precio_total:.2f} pero tienes ${saldo_actual:.2f}', 'error')
-            return redirect('/juego/freefire_latam')
-        
-        # Generar datos de la transacción
-        import random
-        import string
-        numero_control = ''.join(random.choices(string.digits, k=10))
-        transaccion_id = 'FF-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        
-        # Procesar la transacción
-        conn = get_db_connection()
-        try:
-            # Solo actualizar saldo si no es admin
-            if not is_admin:
-                conn.execute('UPDATE usuarios SET saldo = saldo - ? WHERE id = ?', (precio_total, user_id))
-            
-            # Registrar la transacción
-            pines_texto = '\n'.join(pines_codigos)
-            
-            # Para admin, registrar con monto negativo pero agregar etiqueta [ADMIN]
-            if is_admin:
-                pines_texto = f"[ADMIN - PRUEBA/GESTIÓN]\n{pines_texto}"
-                monto_transaccion = -precio_total  # Registrar monto real para mostrar en historial
+                if result.get('status') == 'success':
+                    pines_codigos = [result.get('pin_code')]
+                else:
+                    flash('Sin stock disponible para este paquete.', 'error')
+                    return redirect('/juego/freefire_latam')
             else:
-                monto_transaccion = -precio_total
+                # Para múltiples pines
+                result = pin_manager.request_multiple_pins(monto_id, cantidad)
+                adjust_shared_counter(get_pin_stock.cache_key, monto_id, -count_local_pins_taken(result))
                 
-                # Agregar información de fuente en el pin si viene de API externa
-                if 'inefable_api' in sources_used:
-                    pines_texto += f"\n[Fuente: {', '.join(sources_used)}]"
-            
-            conn.execute('''
-                INSERT INTO transacciones (usuario_id, numero_control, pin, transaccion_id, monto)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, numero_control, pines_texto, transaccion_id, monto_transaccion))
-            
-            # Limitar transacciones a 100 por usuario (aumentado de 30 para evitar eliminaciones frecuentes)
-            conn.execute('''
-                DELETE FROM transacciones 
-                WHERE usuario_id = ? AND id NOT IN (
-                    SELECT id FROM transacciones 
-                    WHERE usuario_id = ? 
-                    ORDER BY fecha DESC 
-                    LIMIT 100
-                )
-            ''', (user_id, user_id))
-            
-            conn.commit()
+                if result.get('status') == 'success':
+                    pines_data = result.get('pins', [])
+                    pines_codigos = [pin['pin_code'] for pin in pines_data]
+                    # Determinar fuentes usadas basado en el resultado
+                    source = result.get('source', 'local_stock')
+                    sources_used = [source]
+                elif result.get('status') == 'partial_success':
+                    # Algunos pines obtenidos, pero no todos
+                    pines_data = result.get('pins', [])
+                    pines_codigos = [pin['pin_code'] for pin in pines_data]
+                    source = result.get('source', 'local_stock')
+                    sources_used = [source]
+                    
+                    # Actualizar cantidad y precio total para los pines realmente obtenidos
+                    cantidad_original = cantidad
+                    cantidad = len(pines_codigos)
+                    precio_total = precio_unitario * cantidad  # Recalcular precio
+                    
+                    flash(f'Advertencia: Solo se obtuvieron {cantidad} pines de los {cantidad_original} solicitados. Precio ajustado a ${precio_total:.2f}', 'warning')
+                else:
+                    flash(f'Error al obtener pines. {result.get("message", "Error desconocido")}', 'error')
+                    return redirect('/juego/freefire_latam')
             
-        except Exception as e:
+            # PASO 2: Verificar que se obtuvieron pines exitosamente
+            if not pines_codigos:
+                flash('No se pudieron obtener pines. Intente nuevamente.', 'error')
+                return redirect('/juego/freefire_latam')
+            # El saldo se verifica con el descuento condicionado dentro de la transacción
+    except Exception as e:
+        flash('Error al obtener pines. Intente nuevamente.', 'error')
+        return redirect('/juego/freefire_latam')
+    
+    # Generar datos de la transacción
+    numero_control, transaccion_id = generate_transaction_ids('FF')
+    
+    # Procesar la compra en una sola transacción: leer el precio vigente, tomar pines locales,
+    # descontar saldo, registrar la transacción y limitar el historial. Si algo falla no se
+    # pierde ningún pin.
+    try:
+        begin_write(conn)
+        package = get_package_by_id(conn, 'freefire_latam', monto_id)
+        if package is None:
             conn.rollback()
-            flash('Error al procesar la transacción. Intente nuevamente.', 'error')
+            if usar_api_externa:
+                add_pins_batch(monto_id, pines_codigos)
+            flash('Paquete no encontrado o inactivo', 'error')
             return redirect('/juego/freefire_latam')
-        finally:
-            conn.close()
+        precio_unitario = package['precio']
+        precio_total = precio_unitario * cantidad
+        paquete_nombre = f"{package['nombre']} x{cantidad}"
         
-        # Actualizar saldo en sesión solo si no es admin
-        if not is_admin:
-            session['saldo'] = saldo_actual - precio_total
+        if not usar_api_externa:
+            pines_codigos = claim_local_pins(conn, monto_id, cantidad)
+            if len(pines_codigos) < cantidad:
+                conn.rollback()
+                if cantidad == 1:
+                    flash('Sin stock disponible para este paquete.', 'error')
+                else:
+                    flash(f'Error al obtener pines. Stock insuficiente. Disponible: {len(pines_codigos)}, Solicitado: {cantidad}', 'error')
+                return redirect('/juego/freefire_latam')
         
-        # Registrar venta en estadísticas semanales (solo para usuarios normales)
+        # Solo actualizar saldo si no es admin
         if not is_admin:
-            register_weekly_sale('freefire_latam', monto_id, package_info.get('nombre', 'Paquete'), precio_unitario, cantidad)
+            nuevo_saldo = debit_user_balance(conn, user_id, precio_total)
+            if nuevo_saldo is None:
+                conn.rollback()
+                if usar_api_externa:
+                    # Los pines de la API externa ya se obtuvieron: guardarlos en el stock local
+                    add_pins_batch(monto_id, pines_codigos)
+                flash(f'Saldo insuficiente. Necesitas ${precio_total:.2f}', 'error')
+                return redirect('/juego/freefire_latam')
         
-        # Guardar datos de la compra en la sesión para mostrar después del redirect
-        if cantidad == 1:
-            # Para un solo pin
-            session['compra_exitosa'] = {
-                'paquete_nombre': paquete_nombre,
-                'monto_compra': precio_total,
-                'numero_control': numero_control,
-                'pin': pines_codigos[0],
-                'transaccion_id': transaccion_id,
-                'cantidad_comprada': cantidad,
-                'source': sources_used[0] if sources_used else 'local_stock'
-            }
+        # Registrar la transacción
+        pines_texto = '\n'.join(pines_codigos)
+        
+        # Para admin, registrar con monto negativo pero agregar etiqueta [ADMIN]
+        if is_admin:
+            pines_texto = f"[ADMIN - PRUEBA/GESTIÓN]\n{pines_texto}"
+            monto_transaccion = -precio_total  # Registrar monto real para mostrar en historial
         else:
-            # Para múltiples pines
-            session['compra_exitosa'] = {
-                'paquete_nombre': paquete_nombre,
-                'monto_compra': precio_total,
-                'numero_control': numero_control,
-                'pines_list': pines_codigos,
-                'transaccion_id': transaccion_id,
-                'cantidad_comprada': cantidad,
-                'sources_used': sources_used
-            }
+            monto_transaccion = -precio_total
+            
+            # Agregar información de fuente en el pin si viene de API externa
+            if 'inefable_api' in sources_used:
+                pines_texto += f"\n[Fuente: {', '.join(sources_used)}]"
+        
+        conn.execute(SQL_INSERT_TRANSACTION, (user_id, numero_control, pines_texto, transaccion_id, monto_transaccion))
+        
+        # Limitar transacciones a 100 por usuario (aumentado de 30 para evitar eliminaciones frecuentes)
+        prune_user_transactions(conn, user_id, 100)
         
-        # Redirect para evitar reenvío del formulario (patrón POST-Redirect-GET)
-        return redirect('/juego/freefire_latam?compra=exitosa')
+        conn.commit()
+        if not usar_api_externa:
+            adjust_shared_counter(get_pin_stock.cache_key, monto_id, -len(pines_codigos))
         
     except Exception as e:
-        flash(f'Error inesperado al procesar la compra: {str(e)}', 'error')
+        conn.rollback()
+        flash('Error al procesar la transacción. Intente nuevamente.', 'error')
         return redirect('/juego/freefire_latam')
+    
+    # Actualizar saldo en sesión solo si no es admin
+    if not is_admin:
+        session['saldo'] = nuevo_saldo
+    
+    # Registrar venta en estadísticas semanales (solo para usuarios normales)
+    if not is_admin:
+        register_weekly_sale('freefire_latam', monto_id, package['nombre'], precio_unitario, cantidad)
+    
+    # Guardar datos de la compra en la sesión para mostrar después del redirect
+    if cantidad == 1:
+        # Para un solo pin
+        session['compra_exitosa'] = {
+            'paquete_nombre': paquete_nombre,
+            'monto_compra': precio_total,
+            'numero_control': numero_control,
+            'pin': pines_codigos[0],
+            'transaccion_id': transaccion_id,
+            'cantidad_comprada': cantidad,
+            'source': sources_used[0] if sources_used else 'local_stock'
+        }
+    else:
+        # Para múltiples pines
+        session['compra_exitosa'] = {
+            'paquete_nombre': paquete_nombre,
+            'monto_compra': precio_total,
+            'numero_control': numero_control,
+            'pines_list': pines_codigos,
+            'transaccion_id': transaccion_id,
+            'cantidad_comprada': cantidad,
+            'sources_used': sources_used
+        }
+    
+    # Redirect para evitar reenvío del formulario (patrón POST-Redirect-GET)
+    return redirect('/juego/freefire_latam?compra=exitosa')
 
 @app.route('/juego/freefire_latam')
 def freefire_latam():
     if 'usuario' not in session:
         return redirect('/auth')
     
-    # Actualizar saldo desde la base de datos
-    user_id = session.get('user_db_id')
-    if user_id:
-        conn = get_db_connection()
-        user = conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()
-        if user:
-            session['saldo'] = user['saldo']
-        conn.close()
+    # Verificar si hay una compra exitosa para mostrar (solo una vez)
+    compra = None
+    
+    # Solo mostrar compra exitosa si viene del redirect POST y hay datos en sesión
+    if request.args.get('compra') == 'exitosa' and 'compra_exitosa' in session:
+        compra = session.pop('compra_exitosa')  # Remover después de usar para evitar mostrar de nuevo
     
-    # Obtener stock local y configuración de fuentes
-    pin_manager = create_pin_manager(DATABASE)
-    local_stock = pin_manager.get_local_stock()
+    # El saldo se muestra desde la sesión: las compras lo actualizan con el valor devuelto por
+    # UPDATE ... RETURNING y el inicio lo refresca; si no alcanza, la compra lo relee
+    
+    # Obtener stock local (en la misma conexión de la petición) y configuración de fuentes
+    local_stock = get_pin_stock()
     pin_sources_config = get_pin_source_config()
     
     # Preparar información de stock considerando la configuración de fuentes
@@ -2478,22 +2735,12 @@ def freefire_latam():
     # Obtener precios dinámicos
     prices = get_package_info_with_prices()
     
-    # Verificar si hay una compra exitosa para mostrar (solo una vez)
-    compra_exitosa = False
-    compra_data = {}
-    
-    # Solo mostrar compra exitosa si viene del redirect POST y hay datos en sesión
-    if request.args.get('compra') == 'exitosa' and 'compra_exitosa' in session:
-        compra_exitosa = True
-        compra_data = session.pop('compra_exitosa')  # Remover después de usar para evitar mostrar de nuevo
-    
     return render_template('freefire_latam.html', 
                          user_id=session.get('id', '00000'),
                          balance=session.get('saldo', 0),
                          stock=stock,
                          prices=prices,
-                         compra_exitosa=compra_exitosa,
-                         **compra_data)  # Desempaquetar los datos de la compra
+                         compra=compra)  # Datos de la compra (None si no hay)
 
 # Rutas para Blood Striker
 @app.route('/juego/bloodstriker')
@@ -2501,33 +2748,24 @@ def bloodstriker():
     if 'usuario' not in session:
         return redirect('/auth')
     
-    # Actualizar saldo desde la base de datos
-    user_id = session.get('user_db_id')
-    if user_id:
-        conn = get_db_connection()
-        user = conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()
-        if user:
-            session['saldo'] = user['saldo']
-        conn.close()
-    
-    # Obtener precios dinámicos de Blood Striker
-    prices = get_bloodstriker_prices()
-    
     # Verificar si hay una compra exitosa para mostrar (solo una vez)
-    compra_exitosa = False
-    compra_data = {}
+    compra = None
     
     # Solo mostrar compra exitosa si viene del redirect POST y hay datos en sesión
     if request.args.get('compra') == 'exitosa' and 'compra_bloodstriker_exitosa' in session:
-        compra_exitosa = True
-        compra_data = session.pop('compra_bloodstriker_exitosa')  # Remover después de usar
+        compra = session.pop('compra_bloodstriker_exitosa')  # Remover después de usar
+    
+    # El saldo se muestra desde la sesión: las compras lo actualizan con el valor devuelto por
+    # UPDATE ... RETURNING y el inicio lo refresca; si no alcanza, la compra lo relee
+    
+    # Obtener precios dinámicos de Blood Striker
+    prices = get_bloodstriker_prices()
     
     return render_template('bloodstriker.html', 
                          user_id=session.get('id', '00000'),
                          balance=session.get('saldo', 0),
                          prices=prices,
-                         compra_exitosa=compra_exitosa,
-                         **compra_data)
+                         compra=compra)
 
 @app.route('/validar/bloodstriker', methods=['POST'])
 def validar_bloodstriker():
@@ -2545,58 +2783,63 @@ def validar_bloodstriker():
     user_id = session.get('user_db_id')
     is_admin = session.get('is_admin', False)
     
-    # Obtener precio dinámico de la base de datos
-    precio = get_bloodstriker_price_by_id(package_id)
-    
-    # Obtener información del paquete usando cache
-    packages_info = get_bloodstriker_prices_cached()
-    package_info = packages_info.get(package_id, {})
-    
-    paquete_nombre = f"{package_info.get('nombre', 'Paquete')} / ${precio:.2f}"
-    
-    if precio == 0:
+    # Rechazo temprano con el cache de precios activos (el precio que se cobra se lee en la transacción)
+    package_info = get_bloodstriker_prices_cached().get(package_id)
+    if package_info is None:
         flash('Paquete no encontrado o inactivo', 'error')
         return redirect('/juego/bloodstriker')
     
-    saldo_actual = session.get('saldo', 0)
+    precio = package_info['precio']
+    paquete_nombre = package_info['display']
     
     # Solo verificar saldo para usuarios normales, admin puede comprar sin saldo
-    if not is_admin and saldo_actual < precio:
-        flash(f'Saldo insuficiente. Necesitas ${precio:.2f} pero tienes ${saldo_actual:.2f}', 'error')
+    if not is_admin and not session_balance_covers(user_id, precio):
+        flash(f'Saldo insuficiente. Necesitas ${precio:.2f} pero tienes ${session.get("saldo", 0):.2f}', 'error')
         return redirect('/juego/bloodstriker')
     
     # Procesar la compra (crear transacción pendiente)
     try:
+        # Descuento de saldo y transacción pendiente en una sola transacción:
+        # create_bloodstriker_transaction hace el commit (o el rollback de ambos)
+        conn = get_db()
+        begin_write(conn)
+        
+        # Precio vigente leído dentro de la transacción (el cache solo sirvió para el rechazo temprano)
+        package = get_package_by_id(conn, 'bloodstriker', package_id)
+        if package is None:
+            conn.rollback()
+            flash('Paquete no encontrado o inactivo', 'error')
+            return redirect('/juego/bloodstriker')
+        precio = package['precio']
+        paquete_nombre = format_package_display(package['nombre'], precio)
+        
         # Solo descontar saldo si no es admin
         if not is_admin:
-            conn = get_db_connection()
-            conn.execute('UPDATE usuarios SET saldo = saldo - ? WHERE id = ?', (precio, user_id))
-            conn.commit()
-            conn.close()
-            session['saldo'] = saldo_actual - precio
+            nuevo_saldo = debit_user_balance(conn, user_id, precio)
+            if nuevo_saldo is None:
+                conn.rollback()
+                flash(f'Saldo insuficiente. Necesitas ${precio:.2f}', 'error')
+                return redirect('/juego/bloodstriker')
         
         # Crear transacción pendiente
         transaction_data = create_bloodstriker_transaction(user_id, player_id, package_id, precio)
         
-        # Obtener datos del usuario para la notificación
-        conn = get_db_connection()
-        user_data = conn.execute('''
-            SELECT nombre, apellido, correo FROM usuarios WHERE id = ?
-        ''', (user_id,)).fetchone()
-        conn.close()
+        if not is_admin:
+            session['saldo'] = nuevo_saldo
         
-        # Enviar notificación por correo al admin (solo si no es admin quien hace la compra)
-        if not is_admin and user_data:
+        # Enviar notificación por correo al admin (solo si no es admin quien hace la compra).
+        # Los datos del usuario ya están en la sesión desde el login
+        if not is_admin:
             notification_data = {
-                'nombre': user_data['nombre'],
-                'apellido': user_data['apellido'],
-                'correo': user_data['correo'],
+                'nombre': session.get('nombre', ''),
+                'apellido': session.get('apellido', ''),
+                'correo': session.get('usuario', ''),
                 'player_id': player_id,
-                'paquete_nombre': package_info.get('nombre', 'Paquete desconocido'),
+                'paquete_nombre': package['nombre'],
                 'precio': precio,
                 'numero_control': transaction_data['numero_control'],
                 'transaccion_id': transaction_data['transaccion_id'],
-                'fecha': convert_to_venezuela_time(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                'fecha': datetime.now(VENEZUELA_TZ).strftime('%Y-%m-%d %H:%M:%S')
             }
             send_bloodstriker_notification(notification_data)
         
@@ -2654,23 +2897,11 @@ def admin_bloodstriker_reject():
     notas = request.form.get('notas', '')
     
     if transaction_id:
-        # Obtener información de la transacción para devolver el saldo
-        conn = get_db_connection()
-        transaction = conn.execute('''
-            SELECT usuario_id, monto FROM transacciones_bloodstriker 
-            WHERE id = ?
-        ''', (transaction_id,)).fetchone()
-        
-        if transaction:
-            # Devolver saldo al usuario (monto es negativo, así que sumamos el valor absoluto)
-            conn.execute('UPDATE usuarios SET saldo = saldo + ? WHERE id = ?', 
-                        (abs(transaction['monto']), transaction['usuario_id']))
-            conn.commit()
-        conn.close()
-        
-        # Actualizar estado de la transacción
-        update_bloodstriker_transaction_status(int(transaction_id), 'rechazado', session.get('user_db_id'), notas)
-        flash('Transacción rechazada y saldo devuelto al usuario', 'success')
+        # Cambiar el estado y devolver el saldo en una sola transacción
+        if reject_bloodstriker_transaction_with_refund(int(transaction_id), session.get('user_db_id'), notas):
+            flash('Transacción rechazada y saldo devuelto al usuario', 'success')
+        else:
+            flash('La transacción no existe o ya fue procesada', 'error')
     else:
         flash('ID de transacción inválido', 'error')
     
@@ -2695,18 +2926,13 @@ def admin_update_bloodstriker_price():
             flash('El precio no puede ser negativo', 'error')
             return redirect('/admin')
         
-        # Obtener información del paquete antes de actualizar
-        conn = get_db_connection()
-        package = conn.execute('SELECT nombre FROM precios_bloodstriker WHERE id = ?', (package_id,)).fetchone()
-        conn.close()
-        
-        if not package:
+        # Actualizar precio; el UPDATE devuelve el nombre del paquete (None si no existe)
+        nombre = update_bloodstriker_price(int(package_id), new_price)
+        if nombre is None:
             flash('Paquete no encontrado', 'error')
             return redirect('/admin')
         
-        # Actualizar precio
-        update_bloodstriker_price(int(package_id), new_price)
-        flash(f'Precio de Blood Striker actualizado exitosamente para {package["nombre"]}: ${new_price:.2f}', 'success')
+        flash(f'Precio de Blood Striker actualizado exitosamente para {nombre}: ${new_price:.2f}', 'success')
         
     except ValueError:
         flash('Precio inválido. Debe ser un número válido.', 'error')
@@ -2739,9 +2965,8 @@ def admin_update_bloodstriker_name():
             return redirect('/admin')
         
         # Obtener información del paquete antes de actualizar
-        conn = get_db_connection()
+        conn = get_db()
         package = conn.execute('SELECT nombre FROM precios_bloodstriker WHERE id = ?', (package_id,)).fetchone()
-        conn.close()
         
         if not package:
             flash('Paquete no encontrado', 'error')
@@ -2777,18 +3002,13 @@ def admin_update_freefire_global_price():
             flash('El precio no puede ser negativo', 'error')
             return redirect('/admin')
         
-        # Obtener información del paquete antes de actualizar
-        conn = get_db_connection()
-        package = conn.execute('SELECT nombre FROM precios_freefire_global WHERE id = ?', (package_id,)).fetchone()
-        conn.close()
-        
-        if not package:
+        # Actualizar precio; el UPDATE devuelve el nombre del paquete (None si no existe)
+        nombre = update_freefire_global_price(int(package_id), new_price)
+        if nombre is None:
             flash('Paquete no encontrado', 'error')
             return redirect('/admin')
         
-        # Actualizar precio
-        update_freefire_global_price(int(package_id), new_price)
-        flash(f'Precio de Free Fire actualizado exitosamente para {package["nombre"]}: ${new_price:.2f}', 'success')
+        flash(f'Precio de Free Fire actualizado exitosamente para {nombre}: ${new_price:.2f}', 'success')
         
     except ValueError:
         flash('Precio inválido. Debe ser un número válido.', 'error')
@@ -2821,9 +3041,8 @@ def admin_update_freefire_global_name():
             return redirect('/admin')
         
         # Obtener información del paquete antes de actualizar
-        conn = get_db_connection()
+        conn = get_db()
         package = conn.execute('SELECT nombre FROM precios_freefire_global WHERE id = ?', (package_id,)).fetchone()
-        conn.close()
         
         if not package:
             flash('Paquete no encontrado', 'error')
@@ -2846,63 +3065,56 @@ def approve_bloodstriker_transaction(transaction_id):
         flash('Acceso denegado. Solo administradores.', 'error')
         return redirect('/auth')
     
+    conn = get_db()
     try:
-        # Obtener información de la transacción de Blood Striker
-        conn = get_db_connection()
+        # Cambio de estado, historial y recorte en una sola transacción. El UPDATE ... RETURNING
+        # aprueba solo solicitudes pendientes y devuelve los datos de la solicitud y del paquete
+        begin_write(conn)
         bs_transaction = conn.execute('''
-            SELECT bs.*, u.nombre, u.apellido, p.nombre as paquete_nombre, p.precio
-            FROM transacciones_bloodstriker bs
-            JOIN usuarios u ON bs.usuario_id = u.id
-            JOIN precios_bloodstriker p ON bs.paquete_id = p.id
-            WHERE bs.id = ?
-        ''', (transaction_id,)).fetchone()
-        
-        if bs_transaction:
-            # Crear transacción normal en el historial
-            conn.execute('''
-                INSERT INTO transacciones (usuario_id, numero_control, pin, transaccion_id, monto)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                bs_transaction['usuario_id'],
-                bs_transaction['numero_control'],
-                f"ID: {bs_transaction['player_id']}",
-                bs_transaction['transaccion_id'],
-                bs_transaction['monto']
-            ))
-            
-            # Limitar transacciones a 100 por usuario (aumentado de 30 para evitar eliminaciones frecuentes)
-            conn.execute('''
-                DELETE FROM transacciones 
-                WHERE usuario_id = ? AND id NOT IN (
-                    SELECT id FROM transacciones 
-                    WHERE usuario_id = ? 
-                    ORDER BY fecha DESC 
-                    LIMIT 100
-                )
-            ''', (bs_transaction['usuario_id'], bs_transaction['usuario_id']))
-            
-            conn.commit()
-            
-            # Registrar venta en estadísticas semanales
-            register_weekly_sale(
-                'bloodstriker', 
-                bs_transaction['paquete_id'], 
-                bs_transaction['paquete_nombre'], 
-                bs_transaction['precio'], 
-                1
-            )
-            
-            # Crear notificación personalizada para el usuario
-            titulo = "🎯 Recarga Blood Striker Aprobada"
-            mensaje = f"Tu recarga de {bs_transaction['paquete_nombre']} por ${bs_transaction['precio']:.2f} ha sido aprobada exitosamente. ID: {bs_transaction['player_id']}"
-            create_personal_notification(bs_transaction['usuario_id'], titulo, mensaje, 'success')
+            UPDATE transacciones_bloodstriker 
+            SET estado = 'aprobado', admin_id = ?, notas = NULL, fecha_procesado = CURRENT_TIMESTAMP
+            WHERE id = ? AND estado = 'pendiente'
+            RETURNING usuario_id, player_id, paquete_id, numero_control, transaccion_id, monto,
+                      (SELECT nombre FROM precios_bloodstriker WHERE id = paquete_id) AS paquete_nombre,
+                      (SELECT precio FROM precios_bloodstriker WHERE id = paquete_id) AS precio
+        ''', (session.get('user_db_id'), transaction_id)).fetchone()
+        
+        if bs_transaction is None:
+            conn.rollback()
+            flash('La transacción no existe o ya fue procesada', 'error')
+            return redirect('/')
         
-        conn.close()
+        # Crear transacción normal en el historial
+        conn.execute(SQL_INSERT_TRANSACTION, (
+            bs_transaction['usuario_id'],
+            bs_transaction['numero_control'],
+            f"ID: {bs_transaction['player_id']}",
+            bs_transaction['transaccion_id'],
+            bs_transaction['monto']
+        ))
+        
+        # Limitar transacciones a 100 por usuario (aumentado de 30 para evitar eliminaciones frecuentes)
+        prune_user_transactions(conn, bs_transaction['usuario_id'], 100)
+        
+        conn.commit()
+        
+        # Registrar venta en estadísticas semanales
+        register_weekly_sale(
+            'bloodstriker', 
+            bs_transaction['paquete_id'], 
+            bs_transaction['paquete_nombre'], 
+            bs_transaction['precio'], 
+            1
+        )
+        
+        # Crear notificación personalizada para el usuario
+        titulo = "🎯 Recarga Blood Striker Aprobada"
+        mensaje = f"Tu recarga de {bs_transaction['paquete_nombre']} por ${bs_transaction['precio']:.2f} ha sido aprobada exitosamente. ID: {bs_transaction['player_id']}"
+        create_personal_notification(bs_transaction['usuario_id'], titulo, mensaje, 'success')
         
-        # Actualizar estado de la transacción de Blood Striker
-        update_bloodstriker_transaction_status(transaction_id, 'aprobado', session.get('user_db_id'))
         flash('Transacción aprobada exitosamente', 'success')
     except Exception as e:
+        conn.rollback()
         flash(f'Error al aprobar transacción: {str(e)}', 'error')
     
     return redirect('/')
@@ -2914,23 +3126,11 @@ def reject_bloodstriker_transaction(transaction_id):
         return redirect('/auth')
     
     try:
-        # Obtener información de la transacción para devolver el saldo
-        conn = get_db_connection()
-        transaction = conn.execute('''
-            SELECT usuario_id, monto FROM transacciones_bloodstriker 
-            WHERE id = ?
-        ''', (transaction_id,)).fetchone()
-        
-        if transaction:
-            # Devolver saldo al usuario (monto es negativo, así que sumamos el valor absoluto)
-            conn.execute('UPDATE usuarios SET saldo = saldo + ? WHERE id = ?', 
-                        (abs(transaction['monto']), transaction['usuario_id']))
-            conn.commit()
-        conn.close()
-        
-        # Actualizar estado de la transacción
-        update_bloodstriker_transaction_status(transaction_id, 'rechazado', session.get('user_db_id'))
-        flash('Transacción rechazada y saldo devuelto al usuario', 'success')
+        # Cambiar el estado y devolver el saldo en una sola transacción
+        if reject_bloodstriker_transaction_with_refund(transaction_id, session.get('user_db_id')):
+            flash('Transacción rechazada y saldo devuelto al usuario', 'success')
+        else:
+            flash('La transacción no existe o ya fue procesada', 'error')
     except Exception as e:
         flash(f'Error al rechazar transacción: {str(e)}', 'error')
     
@@ -3254,7 +3454,7 @@ def admin_simple_stats():
         return jsonify({'error': 'Acceso denegado'}), 403
     
     try:
-        conn = get_db_connection()
+        conn = get_db()
         
         # Estadísticas por juego
         stats = {}
@@ -3295,7 +3495,6 @@ def admin_simple_stats():
             'profit': bs['total_profit'] or 0.0
         }
         
-        conn.close()
         return jsonify(stats)
         
     except Exception as e:
@@ -3317,46 +3516,38 @@ def admin_get_purchase_price(juego, paquete_id):
 
 def get_purchase_prices():
     """Obtiene todos los precios de compra por juego y paquete"""
-    conn = get_db_connection()
+    conn = get_db()
     prices = conn.execute('''
         SELECT * FROM precios_compra 
         WHERE activo = TRUE 
         ORDER BY juego, paquete_id
     ''').fetchall()
-    conn.close()
     return prices
 
+@ttl_cache(PRICE_CACHE_TTL)
+def get_purchase_price_map():
+    """Precios de compra activos como {(juego, paquete_id): precio}, cacheados igual que los
+    precios de venta: cada venta registrada y el análisis de rentabilidad los consultan"""
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT juego, paquete_id, precio_compra FROM precios_compra 
+        WHERE activo = TRUE
+    ''').fetchall()
+    return {(row['juego'], row['paquete_id']): float(row['precio_compra']) for row in rows}
+
 def get_purchase_price(juego, paquete_id):
     """Obtiene el precio de compra para un juego y paquete específico - Compatible con Render"""
-    conn = None
     try:
-        conn = get_db_connection_optimized()
-        
-        # Usar parámetros seguros y validados
-        query = '''
-            SELECT precio_compra FROM precios_compra 
-            WHERE juego = ? AND paquete_id = ? AND activo = TRUE
-        '''
-        
-        result = conn.execute(query, (str(juego), int(paquete_id))).fetchone()
-        
-        if result:
-            return float(result['precio_compra'])
-        else:
-            return 0.0
-            
+        return get_purchase_price_map().get((str(juego), int(paquete_id)), 0.0)
     except Exception as e:
         print(f"Error en get_purchase_price: {e}")
         return 0.0
-    finally:
-        if conn:
-            return_db_connection(conn)
 
 def update_purchase_price(juego, paquete_id, nuevo_precio):
     """Actualiza el precio de compra para un juego y paquete específico - Compatible con Render"""
     conn = None
     try:
-        conn = get_db_connection_optimized()
+        conn = get_db()
         
         # Usar transacción para asegurar consistencia
         conn.execute('BEGIN TRANSACTION')
@@ -3368,6 +3559,7 @@ def update_purchase_price(juego, paquete_id, nuevo_precio):
         
         conn.execute(query, (str(juego), int(paquete_id), float(nuevo_precio)))
         conn.execute('COMMIT')
+        get_purchase_price_map.cache_clear()
         
         return True
         
@@ -3379,13 +3571,10 @@ def update_purchase_price(juego, paquete_id, nuevo_precio):
             except:
                 pass
         return False
-    finally:
-        if conn:
-            return_db_connection(conn)
 
 def get_profit_analysis():
     """Obtiene análisis de rentabilidad por juego y paquete"""
-    conn = get_db_connection()
+    conn = get_db()
     
     # Análisis para Free Fire LATAM
     freefire_latam_analysis = []
@@ -3444,7 +3633,6 @@ def get_profit_analysis():
             'margen_porcentaje': margen
         })
     
-    conn.close()
     return freefire_latam_analysis + freefire_global_analysis + bloodstriker_analysis
 
 def register_weekly_sale(juego, paquete_id, paquete_nombre, precio_venta, cantidad=1):
@@ -3452,7 +3640,7 @@ def register_weekly_sale(juego, paquete_id, paquete_nombre, precio_venta, cantid
     from datetime import datetime
     import pytz
     
-    conn = get_db_connection()
+    conn = get_db()
     
     # Obtener precio de compra
     precio_compra = get_purchase_price(juego, paquete_id)
@@ -3460,13 +3648,13 @@ def register_weekly_sale(juego, paquete_id, paquete_nombre, precio_venta, cantid
     ganancia_total = ganancia_unitaria * cantidad
     
     # Usar zona horaria de Venezuela para calcular el día correcto
-    venezuela_tz = pytz.timezone('America/Caracas')
-    now_venezuela = datetime.now(venezuela_tz)
+    now_venezuela = datetime.now(VENEZUELA_TZ)
     
     # Calcular día del año (formato: YYYY-MM-DD) - resetea a las 12:00 AM
     dia_year = now_venezuela.strftime('%Y-%m-%d')
     
-    # Verificar si ya existe un registro para este día y paquete
+    # Verificar si ya existe un registro para este día y paquete (dentro de la transacción de escritura)
+    begin_write(conn)
     existing = conn.execute('''
         SELECT id, cantidad_vendida, ganancia_total FROM ventas_semanales 
         WHERE juego = ? AND paquete_id = ? AND semana_year = ?
@@ -3493,7 +3681,6 @@ def register_weekly_sale(juego, paquete_id, paquete_nombre, precio_venta, cantid
               ganancia_unitaria, cantidad, ganancia_total, dia_year))
     
     conn.commit()
-    conn.close()
 
 def get_weekly_sales_stats():
     """Obtiene estadísticas de ventas del día actual (corregido para usar días)"""
@@ -3501,13 +3688,12 @@ def get_weekly_sales_stats():
     import pytz
     
     # Usar zona horaria de Venezuela para calcular el día correcto
-    venezuela_tz = pytz.timezone('America/Caracas')
-    now_venezuela = datetime.now(venezuela_tz)
+    now_venezuela = datetime.now(VENEZUELA_TZ)
     
     # Calcular día actual (formato: YYYY-MM-DD) - resetea a las 12:00 AM
     dia_actual = now_venezuela.strftime('%Y-%m-%d')
     
-    conn = get_db_connection()
+    conn = get_db()
     
     # Estadísticas por juego
     stats_by_game = conn.execute('''
@@ -3540,8 +3726,6 @@ def get_weekly_sales_stats():
         WHERE semana_year = ?
     ''', (dia_actual,)).fetchone()
     
-    conn.close()
-    
     return {
         'semana_actual': dia_actual,
         'stats_by_game': stats_by_game,
@@ -3553,7 +3737,7 @@ def clean_old_weekly_sales():
     """Limpia las ventas semanales antiguas (mantiene solo las últimas 4 semanas)"""
     from datetime import datetime, timedelta
     
-    conn = get_db_connection()
+    conn = get_db()
     
     try:
         # Calcular fecha límite (4 semanas atrás)
@@ -3583,6 +3767,7 @@ def clean_old_weekly_sales():
                 weeks_to_delete.append(week_row['semana_year'])
         
         # Eliminar registros antiguos
+        begin_write(conn)
         deleted_count = 0
         for week_to_delete in weeks_to_delete:
             count = conn.execute('''
@@ -3598,8 +3783,6 @@ def clean_old_weekly_sales():
         conn.rollback()
         print(f"Error en clean_old_weekly_sales: {str(e)}")
         return 0
-    finally:
-        conn.close()
 
 def clean_old_transactions():
     """Limpia transacciones antiguas manteniendo solo las del último mes (mejorado)"""
@@ -3620,7 +3803,7 @@ def clean_old_transactions():
     except:
         pass  # Si hay error leyendo el archivo, continuar con la limpieza
     
-    conn = get_db_connection()
+    conn = get_db()
     
     try:
         # Calcular fecha límite (1 MES atrás en lugar de 1 semana)
@@ -3628,6 +3811,7 @@ def clean_old_transactions():
         fecha_limite_str = fecha_limite.strftime('%Y-%m-%d %H:%M:%S')
         
         # Eliminar transacciones normales más antiguas de 1 mes
+        begin_write(conn)
         deleted_normal = conn.execute('''
             DELETE FROM transacciones 
             WHERE fecha < ?
@@ -3658,12 +3842,10 @@ def clean_old_transactions():
         conn.rollback()
         print(f"Error en clean_old_transactions: {str(e)}")
         return 0
-    finally:
-        conn.close()
 
 def reset_all_weekly_sales():
     """Resetea TODAS las estadísticas de ventas semanales (elimina todos los registros)"""
-    conn = get_db_connection()
+    conn = get_db()
     
     try:
         # Contar registros antes de eliminar
@@ -3679,142 +3861,91 @@ def reset_all_weekly_sales():
         conn.rollback()
         print(f"Error en reset_all_weekly_sales: {str(e)}")
         return 0
-    finally:
-        conn.close()
 
 # Funciones para Free Fire Global (nuevo juego)
 def add_pin_freefire_global(monto_id, pin_codigo):
     """Añade un pin de Free Fire Global al stock"""
-    conn = get_db_connection()
-    conn.execute('''
-        INSERT INTO pines_freefire_global (monto_id, pin_codigo)
-        VALUES (?, ?)
-    ''', (monto_id, pin_codigo))
+    conn = get_db()
+    conn.execute(SQL_INSERT_PIN_FREEFIRE_GLOBAL, (monto_id, pin_codigo))
     conn.commit()
-    conn.close()
+    adjust_shared_counter(get_pin_stock_freefire_global.cache_key, monto_id, 1)
 
 def add_pins_batch_freefire_global(monto_id, pins_list):
     """Añade múltiples pines de Free Fire Global al stock en lote"""
-    conn = get_db_connection()
+    # Solo agregar pines no vacíos
+    rows = [(monto_id, p.strip()) for p in pins_list if p.strip()]
+    conn = get_db()
     try:
-        for pin_codigo in pins_list:
-            pin_codigo = pin_codigo.strip()
-            if pin_codigo:  # Solo agregar si el pin no está vacío
-                conn.execute('''
-                    INSERT INTO pines_freefire_global (monto_id, pin_codigo)
-                    VALUES (?, ?)
-                ''', (monto_id, pin_codigo))
+        begin_write(conn)
+        # Un solo executemany dentro de una única transacción (un commit para todo el lote)
+        conn.executemany(SQL_INSERT_PIN_FREEFIRE_GLOBAL, rows)
         conn.commit()
-        return len([p for p in pins_list if p.strip()])  # Retornar cantidad agregada
+        adjust_shared_counter(get_pin_stock_freefire_global.cache_key, monto_id, len(rows))
+        return len(rows)  # Retornar cantidad agregada
     except Exception as e:
         conn.rollback()
         raise e
-    finally:
-        conn.close()
 
+@shared_counters('pin_stock:freefire_global', STOCK_CACHE_TTL)
 def get_pin_stock_freefire_global():
-    """Obtiene el stock de pines de Free Fire Global por monto_id"""
-    conn = get_db_connection()
-    stock = {}
-    for i in range(1, 7):  # monto_id del 1 al 6 para Free Fire Global
-        count = conn.execute('''
-            SELECT COUNT(*) FROM pines_freefire_global 
-            WHERE monto_id = ? AND usado = FALSE
-        ''', (i,)).fetchone()[0]
-        stock[i] = count
-    conn.close()
-    return stock
-
-def get_available_pin_freefire_global(monto_id):
-    """Obtiene un pin disponible de Free Fire Global para el monto especificado y lo elimina"""
-    conn = get_db_connection()
-    pin = conn.execute('''
-        SELECT * FROM pines_freefire_global 
-        WHERE monto_id = ? AND usado = FALSE 
-        LIMIT 1
-    ''', (monto_id,)).fetchone()
-    
-    if pin:
-        # Eliminar el pin de la base de datos
-        conn.execute('''
-            DELETE FROM pines_freefire_global 
-            WHERE id = ?
-        ''', (pin['id'],))
-        conn.commit()
-    
-    conn.close()
-    return pin
+    """Obtiene el stock de pines de Free Fire Global por monto_id (una sola consulta GROUP BY)"""
+    return get_pin_stock_freefire_global_optimized()
+
+def claim_local_pins_freefire_global(conn, monto_id, cantidad):
+    """Toma y elimina hasta `cantidad` pines de Free Fire Global en una sola sentencia.
+    No hace commit: el llamador decide dentro de su transacción."""
+    rows = conn.execute('''
+        DELETE FROM pines_freefire_global 
+        WHERE id IN (
+            SELECT id FROM pines_freefire_global 
+            WHERE monto_id = ? AND usado = FALSE 
+            ORDER BY id 
+            LIMIT ?
+        )
+        RETURNING pin_codigo
+    ''', (monto_id, cantidad)).fetchall()
+    return [row['pin_codigo'] for row in rows]
 
 def get_freefire_global_prices():
-    """Obtiene información de paquetes de Free Fire Global con precios dinámicos"""
-    conn = get_db_connection()
-    packages = conn.execute('''
-        SELECT id, nombre, precio, descripcion 
-        FROM precios_freefire_global 
-        WHERE activo = TRUE 
-        ORDER BY id
-    ''').fetchall()
-    conn.close()
-    
-    # Convertir a diccionario para fácil acceso
-    package_dict = {}
-    for package in packages:
-        package_dict[package['id']] = {
-            'nombre': package['nombre'],
-            'precio': package['precio'],
-            'descripcion': package['descripcion']
-        }
-    
-    return package_dict
-
-def get_freefire_global_price_by_id(monto_id):
-    """Obtiene el precio de un paquete específico de Free Fire Global"""
-    conn = get_db_connection()
-    price = conn.execute('''
-        SELECT precio FROM precios_freefire_global 
-        WHERE id = ? AND activo = TRUE
-    ''', (monto_id,)).fetchone()
-    conn.close()
-    return price['precio'] if price else 0
+    """Obtiene información de paquetes de Free Fire Global con precios dinámicos (cacheado en memoria con TTL)"""
+    return get_freefire_global_prices_cached()
 
 def update_freefire_global_price(package_id, new_price):
-    """Actualiza el precio de un paquete de Free Fire Global"""
-    conn = get_db_connection_optimized()
-    try:
-        conn.execute('''
-            UPDATE precios_freefire_global 
-            SET precio = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (new_price, package_id))
-        conn.commit()
-        # Limpiar cache después de actualizar precios
-        clear_price_cache()
-    finally:
-        return_db_connection(conn)
+    """Actualiza el precio de un paquete de Free Fire Global.
+    Retorna el nombre del paquete (RETURNING) o None si no existe."""
+    conn = get_db()
+    begin_write(conn)
+    package = conn.execute('''
+        UPDATE precios_freefire_global 
+        SET precio = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
+        WHERE id = ?
+        RETURNING nombre
+    ''', (new_price, package_id)).fetchone()
+    conn.commit()
+    # Limpiar cache después de actualizar precios
+    clear_price_cache()
+    return package['nombre'] if package else None
 
 def update_freefire_global_name(package_id, new_name):
     """Actualiza el nombre de un paquete de Free Fire Global"""
-    conn = get_db_connection_optimized()
-    try:
-        conn.execute('''
-            UPDATE precios_freefire_global 
-            SET nombre = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (new_name, package_id))
-        conn.commit()
-        # Limpiar cache después de actualizar nombres
-        clear_price_cache()
-    finally:
-        return_db_connection(conn)
+    conn = get_db()
+    conn.execute('''
+        UPDATE precios_freefire_global 
+        SET nombre = ?, fecha_actualizacion = CURRENT_TIMESTAMP 
+        WHERE id = ?
+    ''', (new_name, package_id))
+    conn.commit()
+    # Limpiar cache después de actualizar nombres
+    clear_price_cache()
 
+@ttl_cache(PRICE_CACHE_TTL)
 def get_all_freefire_global_prices():
     """Obtiene todos los precios de paquetes de Free Fire Global"""
-    conn = get_db_connection()
+    conn = get_db()
     prices = conn.execute('''
         SELECT * FROM precios_freefire_global 
         ORDER BY id
     ''').fetchall()
-    conn.close()
     return prices
 
 # Rutas para Free Fire Global (nuevo juego)
@@ -3823,33 +3954,24 @@ def freefire():
     if 'usuario' not in session:
         return redirect('/auth')
     
-    # Actualizar saldo desde la base de datos
-    user_id = session.get('user_db_id')
-    if user_id:
-        conn = get_db_connection()
-        user = conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()
-        if user:
-            session['saldo'] = user['saldo']
-        conn.close()
-    
-    # Obtener precios dinámicos de Free Fire Global
-    prices = get_freefire_global_prices()
-    
     # Verificar si hay una compra exitosa para mostrar (solo una vez)
-    compra_exitosa = False
-    compra_data = {}
+    compra = None
     
     # Solo mostrar compra exitosa si viene del redirect POST y hay datos en sesión
     if request.args.get('compra') == 'exitosa' and 'compra_freefire_global_exitosa' in session:
-        compra_exitosa = True
-        compra_data = session.pop('compra_freefire_global_exitosa')  # Remover después de usar
+        compra = session.pop('compra_freefire_global_exitosa')  # Remover después de usar
+    
+    # El saldo se muestra desde la sesión: las compras lo actualizan con el valor devuelto por
+    # UPDATE ... RETURNING y el inicio lo refresca; si no alcanza, la compra lo relee
+    
+    # Obtener precios dinámicos de Free Fire Global
+    prices = get_freefire_global_prices()
     
     return render_template('freefire.html', 
                          user_id=session.get('id', '00000'),
                          balance=session.get('saldo', 0),
                          prices=prices,
-                         compra_exitosa=compra_exitosa,
-                         **compra_data)
+                         compra=compra)
 
 @app.route('/validar/freefire', methods=['POST'])
 def validar_freefire():
@@ -3878,62 +4000,53 @@ def validar_freefire():
     user_id = session.get('user_db_id')
     is_admin = session.get('is_admin', False)
     
-    # Obtener precio dinámico de la base de datos
-    precio_unitario = get_freefire_global_price_by_id(monto_id)
-    precio_total = precio_unitario * cantidad
-    
-    # Obtener información del paquete usando cache
-    packages_info = get_freefire_global_prices_cached()
-    package_info = packages_info.get(monto_id, {})
-    
-    paquete_nombre = f"{package_info.get('nombre', 'Paquete')} x{cantidad}" if cantidad > 1 else package_info.get('nombre', 'Paquete')
-    
-    if precio_unitario == 0:
+    # Rechazo temprano con el cache de precios activos (el precio que se cobra se lee en la transacción)
+    package_info = get_freefire_global_prices_cached().get(monto_id)
+    if package_info is None:
         flash('Paquete no encontrado o inactivo', 'error')
         return redirect('/juego/freefire')
     
-    saldo_actual = session.get('saldo', 0)
-    
-    # Solo verificar saldo para usuarios normales, admin puede comprar sin saldo
-    if not is_admin and saldo_actual < precio_total:
-        flash(f'Saldo insuficiente. Necesitas ${precio_total:.2f} pero tienes ${saldo_actual:.2f}', 'error')
-        return redirect('/juego/freefire')
+    precio_unitario = package_info['precio']
+    precio_total = precio_unitario * cantidad
     
-    # Verificar stock local disponible para la cantidad solicitada
-    conn = get_db_connection()
-    stock_disponible = conn.execute('''
-        SELECT COUNT(*) FROM pines_freefire_global 
-        WHERE monto_id = ? AND usado = FALSE
-    ''', (monto_id,)).fetchone()[0]
-    conn.close()
+    paquete_nombre = f"{package_info['nombre']} x{cantidad}" if cantidad > 1 else package_info['nombre']
     
-    if stock_disponible < cantidad:
-        flash(f'Stock insuficiente. Solo hay {stock_disponible} pines disponibles para este paquete.', 'error')
+    # Solo verificar saldo para usuarios normales, admin puede comprar sin saldo
+    if not is_admin and not session_balance_covers(user_id, precio_total):
+        flash(f'Saldo insuficiente. Necesitas ${precio_total:.2f} pero tienes ${session.get("saldo", 0):.2f}', 'error')
         return redirect('/juego/freefire')
     
-    # Obtener los pines necesarios
-    pines_obtenidos = []
-    for i in range(cantidad):
-        pin_disponible = get_available_pin_freefire_global(monto_id)
-        if pin_disponible:
-            pines_obtenidos.append(pin_disponible['pin_codigo'])
-        else:
-            # Si no se pueden obtener todos los pines, devolver error
-            flash('Error al obtener todos los pines solicitados.', 'error')
-            return redirect('/juego/freefire')
-    
     # Generar datos de la transacción
-    import random
-    import string
-    numero_control = ''.join(random.choices(string.digits, k=10))
-    transaccion_id = 'FFG-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    numero_control, transaccion_id = generate_transaction_ids('FFG')
     
-    # Procesar la transacción
-    conn = get_db_connection()
+    # Procesar la transacción: los pines se toman y eliminan en la misma transacción
+    # que el descuento de saldo, así un fallo no pierde pines ni dos compras comparten uno
+    conn = get_db()
     try:
+        begin_write(conn)
+        # Precio vigente leído dentro de la transacción (el cache solo sirvió para el rechazo temprano)
+        package = get_package_by_id(conn, 'freefire_global', monto_id)
+        if package is None:
+            conn.rollback()
+            flash('Paquete no encontrado o inactivo', 'error')
+            return redirect('/juego/freefire')
+        precio_unitario = package['precio']
+        precio_total = precio_unitario * cantidad
+        paquete_nombre = f"{package['nombre']} x{cantidad}" if cantidad > 1 else package['nombre']
+        
+        pines_obtenidos = claim_local_pins_freefire_global(conn, monto_id, cantidad)
+        if len(pines_obtenidos) < cantidad:
+            conn.rollback()
+            flash(f'Stock insuficiente. Solo hay {len(pines_obtenidos)} pines disponibles para este paquete.', 'error')
+            return redirect('/juego/freefire')
+        
         # Solo actualizar saldo si no es admin
         if not is_admin:
-            conn.execute('UPDATE usuarios SET saldo = saldo - ? WHERE id = ?', (precio_total, user_id))
+            nuevo_saldo = debit_user_balance(conn, user_id, precio_total)
+            if nuevo_saldo is None:
+                conn.rollback()
+                flash(f'Saldo insuficiente. Necesitas ${precio_total:.2f}', 'error')
+                return redirect('/juego/freefire')
         
         # Registrar la transacción
         pines_texto = '\n'.join(pines_obtenidos)
@@ -3945,38 +4058,26 @@ def validar_freefire():
         else:
             monto_transaccion = -precio_total
         
-        conn.execute('''
-            INSERT INTO transacciones (usuario_id, numero_control, pin, transaccion_id, monto)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, numero_control, pines_texto, transaccion_id, monto_transaccion))
+        conn.execute(SQL_INSERT_TRANSACTION, (user_id, numero_control, pines_texto, transaccion_id, monto_transaccion))
         
         # Limitar transacciones a 30 por usuario
-        conn.execute('''
-            DELETE FROM transacciones 
-            WHERE usuario_id = ? AND id NOT IN (
-                SELECT id FROM transacciones 
-                WHERE usuario_id = ? 
-                ORDER BY fecha DESC 
-                LIMIT 30
-            )
-        ''', (user_id, user_id))
+        prune_user_transactions(conn, user_id, 30)
         
         conn.commit()
+        adjust_shared_counter(get_pin_stock_freefire_global.cache_key, monto_id, -len(pines_obtenidos))
         
     except Exception as e:
         conn.rollback()
         flash('Error al procesar la transacción. Intente nuevamente.', 'error')
         return redirect('/juego/freefire')
-    finally:
-        conn.close()
     
     # Actualizar saldo en sesión solo si no es admin
     if not is_admin:
-        session['saldo'] = saldo_actual - precio_total
+        session['saldo'] = nuevo_saldo
     
     # Registrar venta en estadísticas semanales (solo para usuarios normales)
     if not is_admin:
-        register_weekly_sale('freefire_global', monto_id, package_info.get('nombre', 'Paquete'), precio_unitario, cantidad)
+        register_weekly_sale('freefire_global', monto_id, package['nombre'], precio_unitario, cantidad)
     
     # Guardar datos de la compra en la sesión para mostrar después del redirect
     if cantidad == 1:
@@ -4048,7 +4149,7 @@ def dashboard():
         preset = 'hoy'
     
     # Actualizar saldo desde la base de datos y obtener transacciones
-    conn = get_db_connection()
+    conn = get_db()
     
     if is_admin:
         # Admin ve estadísticas globales
@@ -4056,22 +4157,24 @@ def dashboard():
         
         # Obtener todas las transacciones filtradas por fecha
         transacciones_filtradas = conn.execute('''
-            SELECT t.*, u.nombre, u.apellido
+            SELECT t.*, u.nombre, u.apellido,
+                   strftime('%Y-%m-%d %H:%M:%S', t.fecha, ?) AS fecha_local
             FROM transacciones t
             JOIN usuarios u ON t.usuario_id = u.id
-            WHERE DATE(t.fecha) BETWEEN ? AND ?
+            WHERE t.fecha >= ? AND t.fecha < DATE(?, '+1 day')
             ORDER BY t.fecha DESC
-        ''', (fecha_inicio, fecha_fin)).fetchall()
+        ''', (VENEZUELA_UTC_OFFSET, fecha_inicio, fecha_fin)).fetchall()
         
         # Obtener todas las transacciones de Blood Striker filtradas por fecha
         transacciones_bs = conn.execute('''
-            SELECT bs.*, u.nombre, u.apellido, p.nombre as paquete_nombre
+            SELECT bs.*, u.nombre, u.apellido, p.nombre as paquete_nombre,
+                   strftime('%Y-%m-%d %H:%M:%S', bs.fecha, ?) AS fecha_local
             FROM transacciones_bloodstriker bs
             JOIN usuarios u ON bs.usuario_id = u.id
             JOIN precios_bloodstriker p ON bs.paquete_id = p.id
-            WHERE DATE(bs.fecha) BETWEEN ? AND ? AND bs.estado = 'aprobado'
+            WHERE bs.estado = 'aprobado' AND bs.fecha >= ? AND bs.fecha < DATE(?, '+1 day')
             ORDER BY bs.fecha DESC
-        ''', (fecha_inicio, fecha_fin)).fetchall()
+        ''', (VENEZUELA_UTC_OFFSET, fecha_inicio, fecha_fin)).fetchall()
         
         # Obtener los 2 usuarios con más compras del mes actual (no del período seleccionado)
         from datetime import datetime
@@ -4095,81 +4198,58 @@ def dashboard():
         
         # Obtener transacciones del usuario filtradas por fecha
         transacciones_filtradas = conn.execute('''
-            SELECT t.*, u.nombre, u.apellido
+            SELECT t.*, u.nombre, u.apellido,
+                   strftime('%Y-%m-%d %H:%M:%S', t.fecha, ?) AS fecha_local
             FROM transacciones t
             JOIN usuarios u ON t.usuario_id = u.id
-            WHERE t.usuario_id = ? AND DATE(t.fecha) BETWEEN ? AND ?
+            WHERE t.usuario_id = ? AND t.fecha >= ? AND t.fecha < DATE(?, '+1 day')
             ORDER BY t.fecha DESC
-        ''', (user_id, fecha_inicio, fecha_fin)).fetchall()
+        ''', (VENEZUELA_UTC_OFFSET, user_id, fecha_inicio, fecha_fin)).fetchall()
         
         # Obtener transacciones de Blood Striker del usuario filtradas por fecha
         transacciones_bs = conn.execute('''
-            SELECT bs.*, u.nombre, u.apellido, p.nombre as paquete_nombre
+            SELECT bs.*, u.nombre, u.apellido, p.nombre as paquete_nombre,
+                   strftime('%Y-%m-%d %H:%M:%S', bs.fecha, ?) AS fecha_local
             FROM transacciones_bloodstriker bs
             JOIN usuarios u ON bs.usuario_id = u.id
             JOIN precios_bloodstriker p ON bs.paquete_id = p.id
-            WHERE bs.usuario_id = ? AND DATE(bs.fecha) BETWEEN ? AND ? AND bs.estado = 'aprobado'
+            WHERE bs.usuario_id = ? AND bs.estado = 'aprobado' AND bs.fecha >= ? AND bs.fecha < DATE(?, '+1 day')
             ORDER BY bs.fecha DESC
-        ''', (user_id, fecha_inicio, fecha_fin)).fetchall()
+        ''', (VENEZUELA_UTC_OFFSET, user_id, fecha_inicio, fecha_fin)).fetchall()
         
         top_users = []  # Los usuarios normales no ven top users
     
-    conn.close()
-    
     # Procesar transacciones normales
-    transacciones_procesadas = []
+    procesadas_normales = []
     monto_total = 0
     
-    # Obtener información de paquetes para mostrar nombres correctos
-    packages_info = get_package_info_with_prices()
-    bloodstriker_packages_info = get_bloodstriker_prices()
-    freefire_global_packages_info = get_freefire_global_prices()
+    # Índice {centavos: nombre} para mostrar nombres correctos
+    # (prioridad: Free Fire LATAM, Free Fire Global, Blood Striker)
+    package_names = build_package_name_lookup(
+        get_package_info_with_prices(),
+        get_freefire_global_prices(),
+        get_bloodstriker_prices()
+    )
     
     for transaction in transacciones_filtradas:
         transaction_dict = dict(transaction)
         monto = abs(transaction['monto'])
         monto_total += monto
         
-        # Buscar el paquete que coincida con el monto
-        paquete_encontrado = False
-        
-        # Buscar en Free Fire LATAM
-        for package_id, package_info in packages_info.items():
-            if abs(monto - package_info['precio']) < 0.01:
-                transaction_dict['paquete'] = package_info['nombre']
-                paquete_encontrado = True
-                break
-        
-        # Si no se encuentra en Free Fire LATAM, buscar en Free Fire Global
-        if not paquete_encontrado:
-            for package_id, package_info in freefire_global_packages_info.items():
-                if abs(monto - package_info['precio']) < 0.01:
-                    transaction_dict['paquete'] = package_info['nombre']
-                    paquete_encontrado = True
-                    break
-        
-        # Si no se encuentra en Free Fire Global, buscar en Blood Striker
-        if not paquete_encontrado:
-            for package_id, package_info in bloodstriker_packages_info.items():
-                if abs(monto - package_info['precio']) < 0.01:
-                    transaction_dict['paquete'] = package_info['nombre']
-                    paquete_encontrado = True
-                    break
-        
-        # Si no se encuentra coincidencia exacta, usar el nombre por defecto
-        if not paquete_encontrado:
-            transaction_dict['paquete'] = f"Paquete ${monto:.2f}"
-        
-        # Convertir fecha a zona horaria de Venezuela
-        transaction_dict['fecha'] = convert_to_venezuela_time(transaction_dict['fecha'])
+        # Buscar el paquete que coincida con el monto; si no hay coincidencia usar el nombre por defecto
+        transaction_dict['paquete'] = package_names.get(price_to_cents(monto), f"Paquete ${monto:.2f}")
+        
+        # Fecha ya convertida a hora de Venezuela en la consulta
+        transaction_dict['fecha'] = transaction_dict.pop('fecha_local')
         transaction_dict['monto'] = monto
         
-        transacciones_procesadas.append(transaction_dict)
+        procesadas_normales.append(transaction_dict)
     
     # Procesar transacciones de Blood Striker aprobadas
+    procesadas_bs = []
     for bs_transaction in transacciones_bs:
         transaction_dict = {
-            'fecha': convert_to_venezuela_time(bs_transaction['fecha']),
+            'fecha': bs_transaction['fecha_local'],
             'monto': abs(bs_transaction['monto']),
             'paquete': bs_transaction['paquete_nombre'],
             'numero_control': bs_transaction['numero_control'],
@@ -4180,10 +4260,11 @@ def dashboard():
             'is_bloodstriker': True
         }
         monto_total += transaction_dict['monto']
-        transacciones_procesadas.append(transaction_dict)
+        procesadas_bs.append(transaction_dict)
     
-    # Ordenar todas las transacciones por fecha
-    transacciones_procesadas.sort(key=lambda x: x['fecha'], reverse=True)
+    # Ambas consultas ya vienen ORDER BY fecha DESC: mezclar en orden lineal en lugar de reordenar
+    transacciones_procesadas = list(heapq.merge(procesadas_normales, procesadas_bs,
+                                                key=lambda x: x['fecha'], reverse=True))
     
     # Calcular estadísticas
     total_transacciones = len(transacciones_procesadas)
@@ -4222,15 +4303,12 @@ def dashboard():
         stats_por_juego[juego]['cantidad'] += 1
         stats_por_juego[juego]['monto'] += transaction['monto']
     
-    # Obtener contador de notificaciones de cartera para usuarios normales
+    # Indicadores de cartera (solo usuarios normales) y noticias sin ver en una sola consulta
     wallet_notification_count = 0
-    if not is_admin and user_id:
-        wallet_notification_count = get_unread_wallet_credits_count(user_id)
-    
-    # Obtener contador de notificaciones de noticias
     news_notification_count = 0
     if user_id:
-        news_notification_count = get_unread_news_count(user_id)
+        wallet_notification_count, news_notification_count, _ = \
+            get_unread_notification_flags(user_id, is_admin=is_admin)
     
     return render_template('dashboard.html', 
                          user=user,
@@ -4369,71 +4447,85 @@ def api_simple_endpoint():
                 'message': f'Saldo insuficiente. Necesitas ${precio_total:.2f} pero tienes ${saldo_actual:.2f}'
             }), 402
         
-        # Usar pin manager para obtener PINs
-        pin_manager = create_pin_manager(DATABASE)
+        conn = get_db()
+        usar_api_externa = get_pin_source(conn, package_id) == 'api_externa'
+        pins_list = []
         
-        if quantity == 1:
-            # Para un solo PIN
-            result = pin_manager.request_pin(package_id)
-            
-            if result.get('status') != 'success':
-                return jsonify({
-                    'status': 'error',
-                    'code': '503',
-                    'message': f'Sin stock disponible para este paquete'
-                }), 503
+        # Con la API externa los PINs se obtienen antes de descontar el saldo (no se pueden
+        # pedir dentro de la transacción); con stock local se toman dentro de ella
+        if usar_api_externa:
+            pin_manager = create_pin_manager(DATABASE)
             
-            pin_code = result.get('pin_code')
-            pins_list = [pin_code]
-        else:
-            # Para múltiples PINs
-            result = pin_manager.request_multiple_pins(package_id, quantity)
-            
-            if result.get('status') not in ['success', 'partial_success']:
+            if quantity == 1:
+                result = pin_manager.request_pin(package_id)
+                adjust_shared_counter(get_pin_stock.cache_key, package_id, -count_local_pins_taken(result))
+                
+                if result.get('status') != 'success':
+                    return jsonify({
+                        'status': 'error',
+                        'code': '503',
+                        'message': f'Sin stock disponible para este paquete'
+                    }), 503
+                
+                pins_list = [result.get('pin_code')]
+            else:
+                result = pin_manager.request_multiple_pins(package_id, quantity)
+                adjust_shared_counter(get_pin_stock.cache_key, package_id, -count_local_pins_taken(result))
+                
+                if result.get('status') not in ['success', 'partial_success']:
+                    return jsonify({
+                        'status': 'error',
+                        'code': '503',
+                        'message': f'Error al obtener PINs: {result.get("message", "Sin stock disponible")}'
+                    }), 503
+                
+                pins_list = [pin['pin_code'] for pin in result.get('pins', [])]
+        
+        # Tomar PINs locales, descontar saldo y registrar la transacción en una sola
+        # transacción: si el saldo ya no alcanza, el rollback devuelve los PINs al stock
+        begin_write(conn)
+        if not usar_api_externa:
+            pins_list = claim_local_pins(conn, package_id, quantity)
+            if len(pins_list) < quantity:
+                # Stock local insuficiente: no se vende una cantidad menor a la pedida
+                conn.rollback()
                 return jsonify({
                     'status': 'error',
                     'code': '503',
-                    'message': f'Error al obtener PINs: {result.get("message", "Sin stock disponible")}'
+                    'message': 'Sin stock disponible para este paquete' if quantity == 1
+                               else f'Error al obtener PINs: Stock insuficiente. Disponible: {len(pins_list)}, Solicitado: {quantity}'
                 }), 503
-            
-            pines_data = result.get('pins', [])
-            pins_list = [pin['pin_code'] for pin in pines_data]
-            
-            if len(pins_list) < quantity:
-                # Ajustar cantidad y precio si no se obtuvieron todos los PINs
-                quantity = len(pins_list)
-                precio_total = precio_unitario * quantity
+        elif len(pins_list) < quantity:
+            # La API externa entregó solo parte (partial_success): ajustar cantidad y precio
+            quantity = len(pins_list)
+            precio_total = precio_unitario * quantity
         
-        # Descontar saldo
-        conn = get_db_connection()
-        nuevo_saldo = saldo_actual - precio_total
-        conn.execute('UPDATE usuarios SET saldo = ? WHERE id = ?', (nuevo_saldo, user['id']))
+        nuevo_saldo = debit_user_balance(conn, user['id'], precio_total)
+        if nuevo_saldo is None:
+            conn.rollback()
+            if usar_api_externa:
+                # Los PINs de la API externa ya se obtuvieron: guardarlos en el stock local
+                add_pins_batch(package_id, pins_list)
+            return jsonify({
+                'status': 'error',
+                'code': '402',
+                'message': f'Saldo insuficiente. Necesitas ${precio_total:.2f}'
+            }), 402
         
         # Crear registro de transacción
         pins_texto = '\n'.join(pins_list)
         
         # Generar datos de la transacción
-        numero_control = ''.join(random.choices(string.digits, k=10))
-        transaccion_id = 'API-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+        numero_control, transaccion_id = generate_transaction_ids('API')
         
-        conn.execute('''
-            INSERT INTO transacciones (usuario_id, numero_control, pin, transaccion_id, monto)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user['id'], numero_control, pins_texto, transaccion_id, -precio_total))
+        conn.execute(SQL_INSERT_TRANSACTION, (user['id'], numero_control, pins_texto, transaccion_id, -precio_total))
         
         # Limitar transacciones a 30 por usuario
-        conn.execute('''
-            DELETE FROM transacciones 
-            WHERE usuario_id = ? AND id NOT IN (
-                SELECT id FROM transacciones 
-                WHERE usuario_id = ? 
-                ORDER BY fecha DESC 
-                LIMIT 30
-            )
-        ''', (user['id'], user['id']))
+        prune_user_transactions(conn, user['id'], 30)
         
         conn.commit()
-        conn.close()
+        if not usar_api_externa:
+            adjust_shared_counter(get_pin_stock.cache_key, package_id, -len(pins_list))
         
         # Preparar respuesta exitosa
         response_data = {
@@ -4480,4 +4572,5 @@ def api_simple_endpoint_post():
     }), 405
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Servidor de desarrollo; en producción usar gunicorn (ver gunicorn.conf.py)
+    app.run(debug=os.environ.get('FLASK_DEBUG', 'False').lower() in ('1', 'true'))
@@ -10,10 +10,9 @@ import hashlib
 import os
 import secrets
 from datetime import datetime
-import random
-import string
 from werkzeug.security import check_password_hash
 from pin_manager import create_pin_manager
+from transaction_ids import generate_transaction_ids
 
 # Crear aplicación Flask para API de conexión
 connection_app = Flask(__name__)
@@ -71,9 +70,8 @@ def get_package_info_with_prices():
 
 def create_transaction_record(user_id, pin_code, package_info, precio):
     """Crea un registro de transacción"""
-    # Generar datos de la transacción
-    numero_control = ''.join(random.choices(string.digits, k=10))
-    transaccion_id = 'API-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    # Generar datos de la transacción (mismo generador que la aplicación principal)
+    numero_control, transaccion_id = generate_transaction_ids('API')
     
     conn = get_db_connection()
     try:
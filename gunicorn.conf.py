@@ -0,0 +1,24 @@
+"""
+Configuración de Gunicorn para producción (se carga automáticamente con: gunicorn app:app)
+"""
+
+import multiprocessing
+import os
+
+# Render y la mayoría de plataformas indican el puerto en PORT
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Varios procesos para usar todos los núcleos y varios hilos por proceso: mientras una
+# petición espera a SQLite, Redis o la API externa, las demás siguen atendiéndose.
+# Se usan hilos (gthread) y no gevent porque sqlite3 es bloqueante y congelaría el bucle
+# de eventos; cada hilo toma su propia conexión del pool de get_db().
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# La API externa de pines puede tardar; no matar al worker antes de que responda
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
@@ -16,8 +16,10 @@ class PinManager:
         
     def get_db_connection(self):
         """Obtiene una conexión a la base de datos"""
-        conn = sqlite3.connect(self.database_path)
+        conn = sqlite3.connect(self.database_path, timeout=20.0)
         conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
         return conn
     
     def get_local_stock(self, monto_id=None):
@@ -33,34 +35,53 @@ class PinManager:
             conn.close()
             return count
         else:
-            # Stock para todos los montos
-            stock = {}
-            for i in range(1, 10):
-                count = conn.execute('''
-                    SELECT COUNT(*) FROM pines_freefire 
-                    WHERE monto_id = ? AND usado = FALSE
-                ''', (i,)).fetchone()[0]
-                stock[i] = count
+            # Stock para todos los montos en una sola consulta agrupada
+            results = conn.execute('''
+                SELECT monto_id, COUNT(*) as count 
+                FROM pines_freefire 
+                WHERE usado = FALSE 
+                GROUP BY monto_id
+            ''').fetchall()
             conn.close()
+            
+            stock = {i: 0 for i in range(1, 10)}
+            for result in results:
+                stock[result['monto_id']] = result['count']
             return stock
     
-    def get_local_pin(self, monto_id):
-        """Obtiene un pin del stock local"""
-        conn = self.get_db_connection()
-        pin = conn.execute('''
-            SELECT * FROM pines_freefire 
-            WHERE monto_id = ? AND usado = FALSE 
-            LIMIT 1
-        ''', (monto_id,)).fetchone()
-        conn.close()
-        return pin
-    
-    def remove_local_pin(self, pin_id):
-        """Elimina un pin del stock local completamente"""
+    def take_local_pins(self, monto_id, cantidad=1):
+        """
+        Toma y elimina pines del stock local en una sola sentencia atómica (DELETE ... RETURNING),
+        de modo que dos peticiones concurrentes nunca reciban el mismo pin.
+        Si no hay suficientes pines no se elimina ninguno.
+        
+        Returns:
+            list: Códigos de pin obtenidos (vacía si no hay stock suficiente)
+        """
         conn = self.get_db_connection()
-        conn.execute('DELETE FROM pines_freefire WHERE id = ?', (pin_id,))
-        conn.commit()
-        conn.close()
+        try:
+            rows = conn.execute('''
+                DELETE FROM pines_freefire 
+                WHERE id IN (
+                    SELECT id FROM pines_freefire 
+                    WHERE monto_id = ? AND usado = FALSE 
+                    ORDER BY id 
+                    LIMIT ?
+                )
+                RETURNING pin_codigo
+            ''', (monto_id, cantidad)).fetchall()
+            
+            if len(rows) < cantidad:
+                conn.rollback()
+                return []
+            
+            conn.commit()
+            return [row['pin_codigo'] for row in rows]
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
     
     def add_local_pin(self, monto_id, pin_code, source='manual'):
         """Añade un pin al stock local"""
@@ -143,16 +164,13 @@ class PinManager:
                 local_stock = self.get_local_stock(monto_id)
                 
                 if local_stock > 0:
-                    # Hay stock local disponible
-                    local_pin = self.get_local_pin(monto_id)
-                    if local_pin:
-                        # Eliminar pin del stock local
-                        self.remove_local_pin(local_pin['id'])
-                        
+                    # Hay stock local disponible: tomar y eliminar el pin en una sola operación
+                    pines = self.take_local_pins(monto_id, 1)
+                    if pines:
                         logger.info(f"Pin obtenido del stock local - Monto: {monto_id}")
                         return {
                             'status': 'success',
-                            'pin_code': local_pin['pin_codigo'],
+                            'pin_code': pines[0],
                             'monto_id': monto_id,
                             'source': 'local_stock',
                             'timestamp': datetime.now().isoformat(),
@@ -295,20 +313,13 @@ class PinManager:
                 'cantidad_solicitada': cantidad
             }
         
-        pines_obtenidos = []
-        
-        # Obtener pines del stock local
-        for i in range(cantidad):
-            local_pin = self.get_local_pin(monto_id)
-            if local_pin:
-                self.remove_local_pin(local_pin['id'])
-                pines_obtenidos.append({
-                    'pin_code': local_pin['pin_codigo'],
-                    'source': 'local_stock'
-                })
-            else:
-                logger.warning(f"Pin local esperado no encontrado en iteración {i+1}")
-                break
+        # Obtener todos los pines del stock local en una sola operación atómica
+        pines_obtenidos = [
+            {'pin_code': pin_code, 'source': 'local_stock'}
+            for pin_code in self.take_local_pins(monto_id, cantidad)
+        ]
+        if not pines_obtenidos:
+            logger.warning(f"Stock local agotado por otra compra para monto_id {monto_id}")
         
         # Resultado final
         if len(pines_obtenidos) == cantidad:
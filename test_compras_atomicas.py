@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Test para verificar que las compras descuentan saldo y toman pines de forma atómica.
+Comprueba el descuento condicionado de saldo, el rollback de los pines tomados cuando
+el saldo no alcanza, la toma de pines sin stock suficiente y el límite del historial.
+"""
+
+import os
+import sys
+
+# Base de datos de prueba: debe configurarse antes de importar la aplicación
+TEST_DB = os.path.abspath('test_compras_atomicas.db')
+if os.path.exists(TEST_DB):
+    os.remove(TEST_DB)
+os.environ['DATABASE_PATH'] = TEST_DB
+os.environ.setdefault('SECRET_KEY', 'test_compras_atomicas')
+
+import app
+from pin_manager import create_pin_manager
+
+def setup_test_data():
+    """Crea un usuario con saldo y algunos pines de prueba"""
+    conn = app.get_db_connection()
+    cursor = conn.execute('''
+        INSERT INTO usuarios (nombre, apellido, telefono, correo, contraseña, saldo)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', ('Test', 'User', '1234567890', 'test@example.com', 'hashed_password', 1.00))
+    user_id = cursor.lastrowid
+
+    conn.executemany('''
+        INSERT INTO pines_freefire (monto_id, pin_codigo)
+        VALUES (?, ?)
+    ''', [(1, 'TEST-PIN-001'), (3, 'TEST-PIN-002'), (3, 'TEST-PIN-003')])
+    conn.commit()
+    conn.close()
+    print("✅ Datos de prueba configurados")
+    return user_id
+
+def get_saldo(conn, user_id):
+    return conn.execute('SELECT saldo FROM usuarios WHERE id = ?', (user_id,)).fetchone()['saldo']
+
+def count_pins(conn, monto_id):
+    return conn.execute('SELECT COUNT(*) FROM pines_freefire WHERE monto_id = ?', (monto_id,)).fetchone()[0]
+
+def test_debit_rechaza_sobregiro(user_id):
+    """debit_user_balance no deja el saldo en negativo"""
+    print("\n🧪 PRUEBA 1: Descuento mayor que el saldo")
+    conn = app.get_db_connection()
+    try:
+        app.begin_write(conn)
+        resultado = app.debit_user_balance(conn, user_id, 2.25)
+        conn.rollback()
+        if resultado is not None or get_saldo(conn, user_id) != 1.00:
+            print(f"❌ Se permitió el sobregiro (resultado: {resultado})")
+            return False
+        print("✅ Descuento de $2.25 rechazado con saldo de $1.00")
+
+        app.begin_write(conn)
+        resultado = app.debit_user_balance(conn, user_id, 0.66)
+        conn.rollback()
+        if resultado is None or abs(resultado - 0.34) > 1e-9:
+            print(f"❌ El descuento válido devolvió {resultado}")
+            return False
+        print(f"✅ Descuento de $0.66 aceptado: nuevo saldo ${resultado:.2f}")
+        return True
+    finally:
+        conn.close()
+
+def test_rollback_devuelve_pines(user_id):
+    """Si el descuento falla, el rollback devuelve los pines tomados al stock"""
+    print("\n🧪 PRUEBA 2: Pines tomados y saldo insuficiente")
+    conn = app.get_db_connection()
+    try:
+        app.begin_write(conn)
+        pines = app.claim_local_pins(conn, 1, 1)
+        if pines != ['TEST-PIN-001']:
+            conn.rollback()
+            print(f"❌ No se tomó el pin esperado: {pines}")
+            return False
+        print(f"✅ Pin tomado dentro de la transacción: {pines[0]}")
+
+        if app.debit_user_balance(conn, user_id, 100.00) is not None:
+            conn.rollback()
+            print("❌ Se aceptó un descuento mayor que el saldo")
+            return False
+        conn.rollback()
+
+        if count_pins(conn, 1) != 1 or get_saldo(conn, user_id) != 1.00:
+            print("❌ El rollback no devolvió el pin o cambió el saldo")
+            return False
+        print("✅ Descuento rechazado: el pin sigue en el stock y el saldo no cambió")
+        return True
+    finally:
+        conn.close()
+
+def test_take_local_pins_sin_stock_suficiente():
+    """PinManager.take_local_pins no elimina nada si no hay stock suficiente"""
+    print("\n🧪 PRUEBA 3: Solicitar más pines de los disponibles")
+    pin_manager = create_pin_manager(TEST_DB)
+    pines = pin_manager.take_local_pins(3, 3)
+
+    conn = app.get_db_connection()
+    try:
+        restantes = count_pins(conn, 3)
+    finally:
+        conn.close()
+
+    if pines or restantes != 2:
+        print(f"❌ Se obtuvieron {len(pines)} pines y quedan {restantes}")
+        return False
+    print("✅ No se entregó ningún pin y el stock sigue con 2 pines")
+    return True
+
+def test_prune_mantiene_keep(user_id):
+    """prune_user_transactions deja exactamente `keep` transacciones"""
+    print("\n🧪 PRUEBA 4: Límite del historial de transacciones")
+    conn = app.get_db_connection()
+    try:
+        # Usuario normal (con contador tx_count) y admin (usuario_id 0, sin fila en usuarios)
+        for usuario_id in (user_id, 0):
+            conn.executemany(app.SQL_INSERT_TRANSACTION, [
+                (usuario_id, f'{i:010d}', f'PIN-{i}', f'TEST-{usuario_id}-{i}', -0.66)
+                for i in range(8)
+            ])
+        conn.commit()
+
+        for usuario_id in (user_id, 0):
+            app.begin_write(conn)
+            app.prune_user_transactions(conn, usuario_id, 5)
+            conn.commit()
+            total = conn.execute('SELECT COUNT(*) FROM transacciones WHERE usuario_id = ?',
+                                 (usuario_id,)).fetchone()[0]
+            if total != 5:
+                print(f"❌ usuario_id {usuario_id}: quedan {total} transacciones en lugar de 5")
+                return False
+            print(f"✅ usuario_id {usuario_id}: quedan exactamente 5 de 8 transacciones")
+        return True
+    finally:
+        conn.close()
+
+def main():
+    print("🧪 INICIANDO PRUEBAS DE COMPRAS ATÓMICAS")
+    print("=" * 50)
+
+    user_id = setup_test_data()
+    resultados = [
+        test_debit_rechaza_sobregiro(user_id),
+        test_rollback_devuelve_pines(user_id),
+        test_take_local_pins_sin_stock_suficiente(),
+        test_prune_mantiene_keep(user_id),
+    ]
+
+    # Limpiar
+    for sufijo in ('', '-wal', '-shm'):
+        if os.path.exists(TEST_DB + sufijo):
+            os.remove(TEST_DB + sufijo)
+
+    print("\n" + "=" * 50)
+    if all(resultados):
+        print("🎉 TODAS LAS PRUEBAS PASARON")
+        return 0
+    print(f"❌ {resultados.count(False)} PRUEBA(S) FALLARON")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
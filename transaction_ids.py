@@ -0,0 +1,19 @@
+import secrets
+import string
+
+_TRANSACTION_CHARS = string.ascii_uppercase + string.digits
+_TRANSACTION_SPACE = len(_TRANSACTION_CHARS) ** 8
+
+def generate_transaction_ids(prefix):
+    """Genera (numero_control, transaccion_id) en el cliente, sin consultar la base de datos.
+    secrets no comparte estado entre hilos y no permite adivinar los identificadores.
+    Cada identificador sale de un solo número aleatorio (una lectura de os.urandom) en lugar
+    de elegir carácter por carácter."""
+    numero_control = f'{secrets.randbelow(10 ** 10):010d}'
+
+    n = secrets.randbelow(_TRANSACTION_SPACE)
+    chars = []
+    for _ in range(8):
+        n, i = divmod(n, len(_TRANSACTION_CHARS))
+        chars.append(_TRANSACTION_CHARS[i])
+    return numero_control, f"{prefix}-" + ''.join(chars)